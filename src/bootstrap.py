@@ -0,0 +1,64 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import json
+import threading
+import logging
+
+l = logging.getLogger('helios')
+
+class BootstrapCache():
+    def __init__(self, cache_file, max_age=7 * 86400):
+        self.__cache_file = cache_file
+        self.__max_age = max_age
+
+        self.__lock = threading.Lock()
+        self.__entries = {}
+
+        self.__load()
+
+    def __load(self):
+        if self.__cache_file and os.path.exists(self.__cache_file):
+            try:
+                with open(self.__cache_file, 'r') as cache_store:
+                    self.__entries = json.load(cache_store)
+            except ValueError as err:
+                l.warning(f"Ignoring unreadable bootstrap cache '{self.__cache_file}' => {err}")
+
+    def __save(self):
+        if not self.__cache_file:
+            return
+
+        tmp_file = f"{self.__cache_file}.tmp"
+        with open(tmp_file, 'w') as cache_store:
+            json.dump(self.__entries, cache_store)
+        os.replace(tmp_file, self.__cache_file)
+
+    def get(self, section, key=None):
+        with self.__lock:
+            entry = self.__entries.get(section)
+
+        # An entry saved for another key, such as a different home address, is
+        # as good as missing.
+        if not entry or entry['key'] != key:
+            return None
+
+        if (time.time() - entry['saved_at']) > self.__max_age:
+            return None
+
+        return entry['value']
+
+    def put(self, section, value, key=None):
+        with self.__lock:
+            self.__entries[section] = { 'key' : key, 'saved_at' : time.time(), 'value' : value }
+            self.__save()
@@ -10,84 +10,222 @@
 # If not, see <https://www.gnu.org/licenses/>.
 
 import logging
+import math
 import time
 
 l = logging.getLogger('helios')
 
+class PIControl():
+    def __init__(self, kp=0.3, ki=0.7, deadband=150, hysteresis=2, min_command_interval=300, voltage=240,
+                 min_amps=5, max_amps=80):
+        self.__kp = kp
+        self.__ki = ki
+        self.__deadband = deadband
+        self.__hysteresis = hysteresis
+        self.__min_command_interval = min_command_interval
+        self.__voltage = voltage
+        self.__min_amps = min_amps
+        self.__max_power = max_amps * voltage
+
+        self.reset()
+
+    def reset(self):
+        self.__integral = None
+        self.__target = None
+        self.__changed_at = None
+
+    def set_applied(self, amps):
+        # Anti-windup, when the vehicles took less than the target the integral
+        # must not keep growing past what they can draw.
+        if self.__integral is not None and self.__target and (amps or 0) < self.__target:
+            self.__integral = min(self.__integral, (amps or 0) * self.__voltage)
+
+    def __hold(self, amps):
+        current = self.__target
+
+        if not current:
+            return amps if amps >= self.__min_amps else None
+
+        # Charging only stops once well below the minimum, and small moves
+        # either way are not worth a command.
+        if amps < self.__min_amps - self.__hysteresis:
+            return None
+        if abs(amps - current) < self.__hysteresis:
+            return current
+
+        return max(amps, self.__min_amps)
+
+    def update(self, surplus, applied):
+        # The surplus is measured with the vehicles drawing what was applied, so
+        # it is the error against exporting nothing beyond the reserve.
+        error = surplus if abs(surplus) > self.__deadband else 0
+
+        if self.__integral is None:
+            self.__integral = (applied or 0) * self.__voltage
+
+        self.__integral = min(max(self.__integral + self.__ki * error, 0), self.__max_power)
+        power = min(max(self.__integral + self.__kp * error, 0), self.__max_power)
+
+        l.debug(f"PI error {int(error)} W, integral {int(self.__integral)} W, output {int(power)} W")
+
+        target = self.__hold(int(power / self.__voltage))
+
+        # Increases wait for the command interval, decreases go out straight away
+        # so the house never draws from the grid or battery for long.
+        now = time.time()
+        increase = (target or 0) > (self.__target or 0)
+        if increase and self.__changed_at and (now - self.__changed_at) < self.__min_command_interval:
+            l.debug(f"Holding {self.__target} amps, last changed {int(now - self.__changed_at)}s ago.")
+            target = self.__target
+
+        if target != self.__target:
+            self.__changed_at = now
+        self.__target = target
+
+        return target
+
 class Amperage():
-    def __init__(self, enphase, home_battery, reserved_power, start_time):
+    def __init__(self, enphase, home_battery, reserved_power, start_time, use_forecast=True, interval=900,
+                 pi=None):
         self.__enphase = enphase
         self.__home_battery = home_battery
         self.__reserved_power = reserved_power
         self.__start_time = start_time
+        self.__use_forecast = use_forecast
+        self.__interval = interval
+        self.__pi = pi
 
         self.__prior_target = None
-        self.__last_power_check = None
-        self.__check_buckets = ( 5, 20, 35, 50 )
+        self.__energy = {}
+
+    def set_applied(self, amps):
+        # Vehicles may take less than the target, only what was applied is
+        # drawing power in the next interval.
+        self.__prior_target = amps or None
+
+        if self.__pi:
+            self.__pi.set_applied(amps)
+
+    def get_energy(self):
+        return dict(self.__energy)
 
-    def check_power(self):
-        ct = time.time()
-        min = time.localtime(ct).tm_min
+    def __observe(self, battery, energy=None):
+        # What the last target was found from, kept with the decision.
+        self.__energy = { 'battery_soc' : battery['level'] }
 
-        if self.__last_power_check:
-            if ct - self.__last_power_check <= 60:
-                return False
+        if energy is not None:
+            self.__energy.update({ k : float(energy[k][-1]) for k in ( 'produced', 'consumed', 'exported' ) })
+
+    def __vehicle_power(self):
+        if not self.__prior_target:
+            return 0
+
+        l.debug(f"prior target set: {self.__prior_target}")
+
+        sec_since_start = time.time() - self.__start_time
+        vehicile_pwr_consumed = 240 * self.__prior_target
+
+        l.debug(f"vehicle power consumed: {vehicile_pwr_consumed}")
+
+        if sec_since_start <= self.__interval:
+            l.debug(f"adjusting vehicle power consumed: ")
+            l.debug(f"{vehicile_pwr_consumed} * {sec_since_start / self.__interval}")
+
+            vehicile_pwr_consumed = vehicile_pwr_consumed * (sec_since_start / self.__interval)
+
+        return vehicile_pwr_consumed
+
+    def __feedback_target(self):
+        target = None
+
+        self.__energy = {}
+
+        battery = self.__enphase.get_battery_charge()
+        self.__observe(battery)
+        if battery['level'] >= self.__home_battery:
+            energy = self.__enphase.get_meters()
+            self.__observe(battery, energy)
+            total_pwr_exported = energy['exported'][-1]
+            battery_charged = battery['intervals']['charged'][-1]
+
+            surplus = total_pwr_exported + battery_charged - self.__reserved_power
+
+            l.debug(f"surplus: {total_pwr_exported} + {battery_charged} - {self.__reserved_power}")
+            l.info(f"Found a surplus of {int(surplus)} watts over the reserve.")
+
+            target = self.__pi.update(surplus, self.__prior_target)
+
+            if target:
+                l.info(f"Found an amperage target of {target}.")
+            else:
+                l.info("No reasonable amperage target could be found.")
+        else:
+            l.info(f"House battery level ({battery['level']}%) too low, no amperage target will be set.")
+            self.__pi.reset()
 
-        if min in self.__check_buckets:
-            self.__last_power_check = ct
-            return True
+        self.__prior_target = target
 
-        return False
+        return target
 
     def find_target(self):
+        if self.__pi:
+            return self.__feedback_target()
+
         target = None
         power_target = None
 
+        self.__energy = {}
+
         battery = self.__enphase.get_battery_charge()
+        self.__observe(battery)
         if battery['level'] >= self.__home_battery:
             energy = self.__enphase.get_meters()
-            total_pwr_produced = energy[-1]['pwr_produced']
-            total_pwr_exported = energy[-1]['pwr_exported']
-            battery_charged = battery['intervals'][-1]['pwr_charged']
-            pwr_produced_change = energy[-1]['pwr_produced'] / energy[-2]['pwr_produced']
+            self.__observe(battery, energy)
+            total_pwr_produced = energy['produced'][-1]
+            total_pwr_consumed = energy['consumed'][-1]
+            total_pwr_exported = energy['exported'][-1]
+            battery_charged = battery['intervals']['charged'][-1]
 
             l.debug(f"total power produced: {total_pwr_produced}")
             l.debug(f"total power exported: {total_pwr_exported}")
             l.debug(f"total power to battery: {battery_charged}")
-            l.debug(f"change in power produced: {pwr_produced_change}")
 
-            if self.__prior_target:
-                l.debug(f"prior target set: {self.__prior_target}")
+            vehicile_pwr_consumed = self.__vehicle_power()
+            surplus = vehicile_pwr_consumed + battery_charged + total_pwr_exported
 
-                sec_since_start = time.time() - self.__start_time
-                vehicile_pwr_consumed = 240 * self.__prior_target
+            forecast = self.__enphase.get_forecast() if self.__use_forecast else None
 
-                l.debug(f"vehicle power consumed: {vehicile_pwr_consumed}")
+            if forecast:
+                # Shift the surplus seen in the last interval by the expected change
+                # in production and household load, rather than lagging it.
+                pwr_produced_change = forecast['pwr_produced'] - total_pwr_produced
+                pwr_consumed_change = forecast['pwr_consumed'] - total_pwr_consumed
+                pwr_produced_next = forecast['pwr_produced']
 
-                if sec_since_start <= 900:
-                    l.debug(f"adjusting vehicle power consumed: ")
-                    l.debug(f"{vehicile_pwr_consumed} * {sec_since_start / 900}")
+                l.debug(f"forecast power produced: {int(forecast['pwr_produced'])}")
+                l.debug(f"forecast power consumed: {int(forecast['pwr_consumed'])}")
+                l.debug(f"power target: ")
+                l.debug(f"({vehicile_pwr_consumed} + {battery_charged} + {total_pwr_exported})")
+                l.debug(f"+ {int(pwr_produced_change)} - {int(pwr_consumed_change)} - {self.__reserved_power}")
 
-                    vehicile_pwr_consumed = vehicile_pwr_consumed * (sec_since_start / 900)
+                power_target = surplus + pwr_produced_change - pwr_consumed_change - self.__reserved_power
+            else:
+                pwr_produced_change = 1
+                if len(energy) > 1 and energy['produced'][-2]:
+                    pwr_produced_change = energy['produced'][-1] / energy['produced'][-2]
+                pwr_produced_next = total_pwr_produced
 
+                l.debug(f"change in power produced: {pwr_produced_change}")
                 l.debug(f"power target: ")
                 l.debug(f"(({vehicile_pwr_consumed} + {battery_charged} + {total_pwr_exported})")
                 l.debug(f"* {pwr_produced_change}) - {self.__reserved_power}")
 
-                power_target = ((vehicile_pwr_consumed + battery_charged + total_pwr_exported) \
-                                 * pwr_produced_change) - self.__reserved_power
+                power_target = (surplus * pwr_produced_change) - self.__reserved_power
 
-                if power_target > total_pwr_produced:
-                    l.debug(f"power target greater than produced: {power_target} > {total_pwr_produced}")
-                    power_target = total_pwr_produced - self.__reserved_power
-                    l.debug(f"power target reset: {power_target}")
-            else:
-                l.debug(f"no prior target power target: ")
-                l.debug(f"(({total_pwr_exported} + {battery_charged})")
-                l.debug(f"* {pwr_produced_change}) - {self.__reserved_power}")
-
-                power_target = ((total_pwr_exported + battery_charged) \
-                                 * pwr_produced_change) - self.__reserved_power
+            if power_target > pwr_produced_next:
+                l.debug(f"power target greater than produced: {power_target} > {pwr_produced_next}")
+                power_target = pwr_produced_next - self.__reserved_power
+                l.debug(f"power target reset: {power_target}")
 
             l.info(f"Found a power target of {int(power_target)} watts.")
             target = int(power_target / 244)
@@ -106,3 +244,128 @@ class Amperage():
 
         return target
 
+class IntervalScheduler():
+    def __init__(self, enphase, interval=900, latency=300, margin=30, min_backoff=60, max_backoff=300,
+                 max_stride=8, active_hours=12):
+        self.__enphase = enphase
+        self.__interval = interval
+        self.__latency = latency
+        self.__margin = margin
+        self.__min_backoff = min_backoff
+        self.__max_backoff = max_backoff
+        self.__max_stride = max_stride
+        self.__active_hours = active_hours
+
+        self.__last_end_at = None
+        self.__next_end_at = None
+        self.__backoff = min_backoff
+        self.__probes = 0
+        self.__waited = False
+
+        self.__stride = 1
+        self.__quota_at = None
+        self.__calls_per_decision = None
+
+    def get_latency(self):
+        return self.__latency
+
+    def get_stride(self):
+        return self.__stride
+
+    def set_active_hours(self, hours):
+        self.__active_hours = max(hours, 1)
+
+    def __budget(self):
+        # Decisions are spread over what is left of the monthly quota, each one
+        # costing what the last ones did, probes and background fetches included.
+        quota = self.__enphase.get_quota()
+        if not quota:
+            return 1
+
+        if self.__quota_at is not None and quota['month'] <= self.__quota_at:
+            calls = self.__quota_at - quota['month']
+            if self.__calls_per_decision is None:
+                self.__calls_per_decision = calls
+            else:
+                self.__calls_per_decision = 0.7 * self.__calls_per_decision + 0.3 * calls
+        self.__quota_at = quota['month']
+
+        if quota['month'] <= 0:
+            l.warning("Enphase monthly quota exhausted, deciding as rarely as possible.")
+            return self.__max_stride
+
+        # Only the hours the sun is up are spent deciding.
+        per_decision = max(self.__calls_per_decision or 3, 1)
+        decisions_per_hour = quota['per_hour'] * 24 / self.__active_hours / per_decision
+        stride = min(max(math.ceil(3600 / self.__interval / decisions_per_hour), 1), self.__max_stride)
+
+        if stride != self.__stride:
+            l.info(f"Deciding every {stride} interval(s), {quota['month']} Enphase requests left this month "
+                   f"at {per_decision:.1f} per decision.")
+
+        return stride
+
+    def poll(self):
+        # Returns how long to wait before polling again, or 0 once the next
+        # interval has been published.
+        if not self.__next_end_at:
+            if not self.__last_end_at:
+                self.__last_end_at = self.__enphase.get_latest_interval_end()
+            if not self.__last_end_at:
+                self.__last_end_at = int(time.time() // self.__interval * self.__interval) - self.__interval
+
+            self.__stride = self.__budget()
+            self.__next_end_at = self.__last_end_at + self.__interval * self.__stride
+            self.__backoff = self.__min_backoff * self.__stride
+            self.__probes = 0
+            self.__waited = False
+
+            delay = self.__next_end_at + self.__latency + self.__margin - time.time()
+            if delay > 0:
+                l.info(f"Next interval expected in {int(delay)} seconds.")
+                self.__waited = True
+                return delay
+
+        end_at = self.__enphase.get_latest_interval_end(probe=True)
+        self.__probes += 1
+
+        if not end_at or end_at < self.__next_end_at:
+            # An interval still missing a whole interval after it was due is
+            # given up on, so the control loop finds the telemetry missing
+            # rather than waiting on it for ever.
+            if time.time() > self.__next_end_at + self.__latency + self.__margin + self.__interval * self.__stride:
+                l.warning(f"Interval ending {time.ctime(self.__next_end_at)} was not published, deciding without it.")
+                self.__last_end_at = self.__next_end_at
+                self.__next_end_at = None
+                return 0
+
+            l.debug(f"Interval ending {time.ctime(self.__next_end_at)} not published yet, retrying in {self.__backoff} seconds.")
+            backoff = self.__backoff
+            self.__backoff = min(self.__backoff * 2, self.__max_backoff * self.__stride)
+            return backoff
+
+        # Landing on the first probe only bounds the latency from above, so
+        # creep the estimate down; otherwise move towards what was observed.
+        # Late probes, after the loop was busy elsewhere, say nothing about it.
+        if self.__waited:
+            observed = time.time() - end_at
+
+            if self.__probes == 1:
+                self.__latency = max(0, min(self.__latency, observed) - self.__margin)
+            else:
+                self.__latency = 0.7 * self.__latency + 0.3 * observed
+
+        l.debug(f"Interval ending {time.ctime(end_at)} landed, publish latency estimate {int(self.__latency)} seconds.")
+
+        self.__last_end_at = end_at
+        self.__next_end_at = None
+
+        return 0
+
+    def wait_for_interval(self):
+        delay = self.poll()
+        while delay:
+            time.sleep(delay)
+            delay = self.poll()
+
+        return self.__last_end_at
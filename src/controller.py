@@ -0,0 +1,584 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import heapq
+import itertools
+import threading
+import logging
+import traceback
+
+from datetime import datetime
+from dateutil import tz as timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from control import Amperage, IntervalScheduler, PIControl
+from solar.enphase import EnphaseInterface
+from solar.envoy import EnvoyInterface
+from solar.series import TelemetryUnavailable
+from vehicles.tesla import TeslaSelector
+from vehicles.allocator import SurplusAllocator
+from vehicles.sessions import SessionLog
+from geo.geoapify import GeoapifyAPI
+from geo.geofence import Geofence, GeocodeCache
+from net import metrics
+from bootstrap import BootstrapCache
+
+l = logging.getLogger('helios')
+
+HOME_FIELDS = ( 'street', 'city', 'state', 'postcode' )
+
+def build_enphase(c, deadline=150):
+    return EnphaseInterface(c['enphase']['system_id'],
+                            c['enphase']['api_key'],
+                            c['enphase']['client_id'],
+                            c['enphase']['client_secret'],
+                            c['enphase']['auth_code'],
+                            c['enphase']['token_file'],
+                            c['enphase'].get('store_file', '.enphase_telemetry.db'),
+                            c['enphase'].get('generation_file', '.generation_profile.json'),
+                            c['enphase'].get('generation_days', 14),
+                            c['enphase'].get('quota'),
+                            c['enphase'].get('base_url', 'https://api.enphaseenergy.com'),
+                            c['enphase'].get('forecast'),
+                            deadline)
+
+def build_envoy(c, deadline=10):
+    return EnvoyInterface(c['envoy']['url'],
+                          c['envoy'].get('token'),
+                          c['envoy'].get('verify', False),
+                          c['envoy'].get('window', 60),
+                          c['envoy'].get('history', 3600),
+                          deadline=deadline,
+                          sample_interval=c['envoy'].get('sample_interval', 5))
+
+def build_allocator(c):
+    return SurplusAllocator(c['tesla'].get('min_amps', 5), c['tesla'].get('priorities'))
+
+def build_geocode_cache(c):
+    return GeocodeCache(c['geoapify'].get('cache_file', '.geocode_cache.json'),
+                        c['geoapify'].get('cache_size', 1024))
+
+class SiteController():
+    def __init__(self, name, c, start_time, geocode_cache=None, vehicle_pool=None, harness=None,
+                 restart_delay=3600):
+        self.name = name
+
+        self.__c = c
+        self.__start_time = start_time
+        self.__geocode_cache = geocode_cache
+        self.__vehicle_pool = vehicle_pool
+        self.__harness = harness
+        self.__restart_delay = restart_delay
+
+        bootstrap = c.get('bootstrap', {})
+        self.__cache = BootstrapCache(bootstrap.get('cache_file', f".{name}_bootstrap.json"),
+                                      bootstrap.get('max_age', 7 * 86400))
+
+        self.__session_log = SessionLog(c['tesla'].get('session_file', f".{name}_sessions.db"),
+                                        c['tesla'].get('session_retention_days', 365))
+
+        self.__pending = None
+        self.__enphase = None
+        self.__envoy = None
+        self.__selector = None
+
+        self.__reset()
+
+    def __reset(self):
+        for service in ( self.__enphase, self.__envoy, self.__selector ):
+            if service:
+                service.close()
+
+        self.__tz = None
+        self.__home = None
+        self.__geoapify = None
+        self.__geofence = None
+        self.__enphase = None
+        self.__envoy = None
+        self.__selector = None
+        self.__amp = None
+        self.__scheduler = None
+
+        self.__gen_range = []
+        self.__amp_target = None
+        self.__applied = 0
+        self.__waiting = False
+        self.__stale = False
+        self.__blind_since = None
+
+    def __address(self):
+        return [ self.__c['home'][k] for k in HOME_FIELDS ]
+
+    def __locate(self):
+        home_ll = self.__geoapify.get_lat_lon(*self.__address())
+
+        return { 'lat' : home_ll['lat'],
+                 'lon' : home_ll['lon'],
+                 'tz'  : self.__geoapify.get_timezone_at(home_ll['lat'], home_ll['lon']) }
+
+    def __local_day(self):
+        return datetime.fromtimestamp(time.time(), tz=timezone.gettz(self.__tz)).date().isoformat()
+
+    def __bootstrap(self):
+        c = self.__c
+
+        self.__geoapify = GeoapifyAPI(c['geoapify']['api_url'], c['geoapify']['api_key'])
+
+        # What was found on the last start is used straight away and checked
+        # again once the first iteration is done.
+        home = self.__cache.get('home', self.__address())
+        roster = self.__cache.get('vehicles', c['tesla']['token_file'])
+
+        self.__stale = home is not None or roster is not None
+
+        if home is None:
+            home = self.__locate()
+            self.__cache.put('home', home, self.__address())
+        else:
+            l.info("Using cached home location.")
+
+        self.__home = home
+        self.__tz = home['tz']
+
+        l.info(f"Found timezone of {self.__tz}.")
+
+        self.__geofence = Geofence(self.__geoapify, c['home']['street'], { 'lat' : home['lat'], 'lon' : home['lon'] },
+                                   c['home'].get('radius', 100), c['home'].get('radius_margin', 25),
+                                   self.__geocode_cache or build_geocode_cache(c))
+
+        self.__build_enphase()
+
+        self.__build_selector(roster)
+
+        if roster is None:
+            self.__cache.put('vehicles', self.__selector.get_roster(), c['tesla']['token_file'])
+        else:
+            l.info(f"Using cached roster of {len(roster)} vehicle(s).")
+
+        self.__build_control()
+
+        gen_range = self.__cache.get('generation_range', self.__local_day())
+        if gen_range:
+            l.info(f"Using cached generation range of {gen_range[0]}:00 to {gen_range[-1]}:00.")
+            self.__set_generation_range(gen_range)
+            self.__stale = True
+
+        l.info("Entering control loop ...")
+
+    def __cycle(self):
+        c = self.__c
+
+        if 'envoy' in c:
+            return c['envoy'].get('window', 60)
+
+        return c.get('scheduler', {}).get('interval', 900)
+
+    def __build_enphase(self):
+        # Retries give up well before the next decision is due.
+        deadline = self.__c.get('retry', {}).get('deadline', self.__cycle() / 6)
+
+        enphase = build_enphase(self.__c, deadline)
+        try:
+            enphase.authorize()
+        except Exception:
+            enphase.close()
+            raise
+
+        # The old interface's token refresh and store are let go of only once
+        # the new one is up.
+        if self.__enphase:
+            self.__enphase.close()
+        self.__enphase = enphase
+
+    def __build_selector(self, roster):
+        c = self.__c
+
+        tesla_urls = { k : c['tesla'][k] for k in ( 'api_url', 'auth_url' ) if k in c['tesla'] }
+
+        selector = TeslaSelector(self.__geofence, c['tesla']['token_file'], c['tesla'].get('snapshot_ttl', 60),
+                                 c['tesla'].get('max_workers', 4), c['tesla'].get('vehicle_deadline', 60),
+                                 build_allocator(c), self.__vehicle_pool, roster, self.__session_log,
+                                 **tesla_urls)
+
+        if self.__selector:
+            self.__selector.close()
+        self.__selector = selector
+
+    def __build_control(self):
+        c = self.__c
+
+        # Live readings come from the local Envoy when there is one, the cloud API
+        # still provides the history the generation range is built from.
+        if self.__envoy:
+            self.__envoy.close()
+            self.__envoy = None
+
+        telemetry = self.__enphase
+        schedule = c.get('scheduler', {})
+        if 'envoy' in c:
+            telemetry = self.__envoy = build_envoy(c, c.get('retry', {}).get('deadline', self.__cycle() / 6))
+            schedule = dict(schedule, interval=telemetry.get_interval(), latency=0,
+                            margin=c['envoy'].get('margin', 1))
+            l.info(f"Reading live telemetry from the Envoy every {telemetry.get_interval()} seconds.")
+
+        pi = None
+        if c.get('control', {}).get('mode') == 'pi':
+            pi = PIControl(min_amps=c['tesla'].get('min_amps', 5), **c['control'].get('pi', {}))
+
+        self.__amp = Amperage(telemetry, c['home_battery'], c['reserved_power'], self.__start_time,
+                              c.get('use_forecast', True), schedule.get('interval', 900), pi)
+        self.__amp.set_applied(self.__applied)
+
+        self.__scheduler = IntervalScheduler(telemetry, **schedule)
+        if self.__gen_range:
+            self.__scheduler.set_active_hours(len(self.__gen_range))
+
+    def reload(self, c):
+        # Called from the main thread, the new configuration is applied by the
+        # site itself at its next step.
+        self.__pending = c
+
+    def __apply(self, c):
+        old = self.__c
+        changed = sorted(k for k in set(old) | set(c) if old.get(k) != c.get(k))
+
+        if not changed:
+            l.info("Configuration unchanged.")
+            return
+
+        l.info(f"Configuration changed: {', '.join(changed)}.")
+        self.__c = c
+
+        if 'bootstrap' in changed:
+            bootstrap = c.get('bootstrap', {})
+            self.__cache = BootstrapCache(bootstrap.get('cache_file', f".{self.name}_bootstrap.json"),
+                                          bootstrap.get('max_age', 7 * 86400))
+
+        if 'tesla' in changed and self.__session_settings(old) != self.__session_settings(c):
+            self.shutdown()
+            self.__reset()
+            self.__session_log.close()
+            self.__session_log = SessionLog(*self.__session_settings(c))
+
+        # Not bootstrapped yet, or starting over, the new settings are picked up
+        # by the next bootstrap.
+        if not self.__selector:
+            return
+
+        if set(changed) & { 'home', 'geoapify' }:
+            l.info("Home or geocoding settings changed, starting over.")
+            self.shutdown()
+            self.__reset()
+            return
+
+        if set(changed) & { 'enphase', 'retry', 'envoy', 'scheduler' }:
+            l.info("Rebuilding the Enphase interface.")
+            self.__build_enphase()
+
+        fields = set()
+        if 'tesla' in changed:
+            fields = { k for k in set(old['tesla']) | set(c['tesla']) if old['tesla'].get(k) != c['tesla'].get(k) }
+
+            if fields <= { 'min_amps', 'priorities' }:
+                l.info("Updating the vehicle allocator.")
+                self.__selector.set_allocator(build_allocator(c))
+            else:
+                l.info("Rebuilding the vehicle selector.")
+                roster = self.__selector.get_roster()
+                self.shutdown()
+                self.__applied = 0
+                self.__amp.set_applied(0)
+                self.__build_selector(roster)
+
+                # The vehicles were released, decide again rather than wait.
+                self.__waiting = False
+
+        # What the scheduler and the PI controller have learnt is kept unless
+        # their own settings changed, the PI controller also holds min_amps.
+        control = { 'reserved_power', 'home_battery', 'use_forecast', 'control', 'scheduler',
+                    'enphase', 'envoy', 'retry' }
+        if set(changed) & control or ('min_amps' in fields and c.get('control', {}).get('mode') == 'pi'):
+            l.info("Rebuilding the amperage controller and scheduler.")
+            self.__build_control()
+
+    def __session_settings(self, c):
+        return ( c['tesla'].get('session_file', f".{self.name}_sessions.db"),
+                 c['tesla'].get('session_retention_days', 365) )
+
+    def __revalidate(self):
+        c = self.__c
+
+        self.__stale = False
+
+        l.info("Checking the cached start up state ...")
+        try:
+            home = self.__locate()
+            vehicles = self.__selector.get_vehicles()
+        except Exception as err:
+            l.error(f"Failed to check the cached start up state => {err}")
+            return
+
+        if home != self.__home:
+            l.warning("Home location has changed since it was cached, starting over.")
+            self.__cache.put('home', home, self.__address())
+            self.shutdown()
+            self.__reset()
+            return
+
+        self.__selector.update_roster(vehicles)
+        self.__cache.put('vehicles', self.__selector.get_roster(), c['tesla']['token_file'])
+
+        self.__update_generation_range()
+
+    def __update_generation_range(self):
+        gen_range = self.__enphase.get_generation_range(self.__tz)
+        if len(gen_range) == 0:
+            l.error("Failed get generation range.")
+            return False
+
+        l.info(f"Found generation range of {gen_range[0]}:00 to {gen_range[-1]}:00.")
+        self.__set_generation_range(gen_range)
+        self.__cache.put('generation_range', gen_range, self.__local_day())
+
+        return True
+
+    def __set_generation_range(self, gen_range):
+        self.__gen_range = gen_range
+
+        # The quota is only spent while the sun is up.
+        self.__scheduler.set_active_hours(len(gen_range))
+
+    def __end_iteration(self, start, outcome):
+        metrics.LOOP_SECONDS.observe(time.time() - start, site=self.name, outcome=outcome)
+        metrics.AMP_TARGET.set(self.__amp_target or 0, site=self.name)
+
+    def __iterate(self):
+        iteration_start = time.time()
+
+        if self.__harness:
+            self.__harness.iteration()
+
+        l.info("Checking to see if anything needs to be adjusted ...")
+        self.__selector.expire_snapshots()
+
+        local_hour = datetime.fromtimestamp(time.time(), tz=timezone.gettz(self.__tz)).hour
+
+        if local_hour == 0:
+            self.__update_generation_range()
+
+        if local_hour not in self.__gen_range:
+            l.info("Outside of solar generation range. Will check again alater.")
+            self.__end_iteration(iteration_start, 'idle')
+            return 300
+
+        candidates = self.__selector.evaluate()
+
+        if not candidates:
+            l.info("No vehicle at home, connected and in need of charge.  Will check again later ...")
+            self.__selector.allocate(None)
+
+            self.__amp_target = None
+
+            self.__end_iteration(iteration_start, 'no_vehicle')
+            return 300
+
+        l.info(f"{len(candidates)} vehicle(s) connected at home and solar power is being generated.")
+        try:
+            self.__amp_target = self.__amp.find_target()
+        except TelemetryUnavailable as err:
+            return self.__skip(iteration_start, err)
+
+        self.__blind_since = None
+
+        allocation = self.__selector.allocate(self.__amp_target, self.__amp.get_energy())
+        self.__applied = sum(allocation.values())
+        self.__amp.set_applied(self.__applied)
+
+        self.__end_iteration(iteration_start, 'control')
+
+        if self.__harness:
+            self.__harness.decision(self.__amp_target)
+
+        self.__waiting = True
+
+        return 0
+
+    def __skip(self, iteration_start, err):
+        # Vehicles keep their allocation while the telemetry catches up, and are
+        # stopped once it has been missing for a whole cycle.
+        l.warning(f"Skipping this cycle => {err}")
+
+        now = time.time()
+        if self.__blind_since is None:
+            self.__blind_since = now
+        elif (now - self.__blind_since) >= self.__cycle():
+            l.warning(f"No telemetry for {int(now - self.__blind_since)} seconds, stopping the vehicles.")
+            self.__amp_target = None
+            self.__selector.allocate(None)
+            self.__applied = 0
+            self.__amp.set_applied(0)
+
+        self.__end_iteration(iteration_start, 'no_telemetry')
+        self.__waiting = True
+
+        return 0
+
+    def step(self):
+        # Runs until the site has to wait, and returns how many seconds for.
+        if self.__pending is not None:
+            c, self.__pending = self.__pending, None
+            self.__apply(c)
+
+        if not self.__selector:
+            self.__bootstrap()
+        elif self.__stale:
+            self.__revalidate()
+            if not self.__selector:
+                return 0
+
+        if not self.__gen_range and not self.__update_generation_range():
+            return 300
+
+        if self.__waiting:
+            delay = self.__scheduler.poll()
+            if delay:
+                return delay
+
+            self.__waiting = False
+
+        return self.__iterate()
+
+    def fail(self):
+        l.error(traceback.format_exc())
+
+        # Everything is rebuilt on the next step, as a restart of a single site
+        # controller would.
+        self.shutdown()
+        self.__reset()
+
+        return self.__restart_delay
+
+    def shutdown(self):
+        if not self.__selector:
+            return
+
+        # Past the end of a replayed trace there are no responses left to
+        # release the vehicles with.
+        if self.__harness and self.__harness.exhausted():
+            l.info("Trace exhausted, leaving the vehicles as they are.")
+            return
+
+        l.info("Cleaning up ...")
+        try:
+            self.__selector.release_all()
+        except Exception as err:
+            l.error(f"Failed to release vehicles => {err}")
+
+class SiteScheduler():
+    def __init__(self, max_workers=4, loader=None, reload_poll=1):
+        self.__pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='site')
+        self.__loader = loader
+        self.__reload_poll = reload_poll if loader else None
+
+        self.__cond = threading.Condition()
+        self.__queue = []
+        self.__sequence = itertools.count()
+        self.__running = 0
+        self.__sites = []
+        self.__reload_requested = False
+
+    def __push(self, site, delay):
+        heapq.heappush(self.__queue, (time.time() + delay, next(self.__sequence), site))
+        self.__cond.notify()
+
+    def add(self, site, delay=0):
+        with self.__cond:
+            self.__sites.append(site)
+            self.__push(site, delay)
+
+    def __wait_time(self, delay):
+        return min(delay, self.__reload_poll) if self.__reload_poll else delay
+
+    def request_reload(self):
+        # Safe from a signal handler, the reload itself happens in run().
+        self.__reload_requested = True
+
+    def __reload(self):
+        self.__reload_requested = False
+
+        try:
+            sites = dict(self.__loader())
+        except Exception as err:
+            l.error(f"Failed to reload the configuration, keeping the current one => {err}")
+            return
+
+        for name in sorted(set(sites) - { site.name for site in self.__sites }):
+            l.warning(f"Site {name} is new, it will only be started on the next restart.")
+
+        for site in self.__sites:
+            if site.name not in sites:
+                l.warning(f"Site {site.name} is no longer configured, it will only be stopped on the next restart.")
+                continue
+
+            site.reload(sites[site.name])
+
+        # Every waiting site steps straight away to apply its new configuration.
+        now = time.time()
+        self.__queue = [ (min(due, now), sequence, site) for due, sequence, site in self.__queue ]
+        heapq.heapify(self.__queue)
+
+    def __step(self, site):
+        threading.current_thread().name = site.name
+
+        try:
+            delay = site.step()
+        except Exception:
+            delay = site.fail()
+
+        with self.__cond:
+            self.__running -= 1
+            self.__push(site, delay)
+
+    def run(self):
+        while True:
+            with self.__cond:
+                if self.__reload_requested and self.__loader:
+                    self.__reload()
+
+                if not self.__queue:
+                    self.__cond.wait(self.__reload_poll)
+                    continue
+
+                due, _, site = self.__queue[0]
+                delay = due - time.time()
+
+                if delay <= 0:
+                    heapq.heappop(self.__queue)
+                    self.__running += 1
+                    self.__pool.submit(self.__step, site)
+                    continue
+
+                # Waits are cut short so a reload is never held up for long.
+                if self.__running:
+                    self.__cond.wait(self.__wait_time(delay))
+                    continue
+
+            # Nothing is in flight, sleeping outright keeps a virtual clock in step.
+            time.sleep(self.__wait_time(delay))
+
+    def shutdown(self):
+        # A step still running may be sending commands to the vehicles, the
+        # release waits for it to finish rather than race it.
+        self.__pool.shutdown(wait=True, cancel_futures=True)
+
+        for site in self.__sites:
+            site.shutdown()
@@ -9,16 +9,32 @@
 # You should have received a copy of the GNU General Public License along with Helios.
 # If not, see <https://www.gnu.org/licenses/>.
 
-import requests
 import urllib
 import json
 import logging
 import pprint
+import threading
 
-from timezonefinder import TimezoneFinder
+from net import transport
 
 l = logging.getLogger('helios')
 
+_tzf_lock = threading.Lock()
+_tzf = None
+
+def timezone_at(lat, lon):
+    global _tzf
+
+    # Importing and building the finder loads its polygon data and takes a
+    # while, only pay for it when a timezone is actually looked up. Sites share
+    # the one finder.
+    with _tzf_lock:
+        if not _tzf:
+            from timezonefinder import TimezoneFinder
+            _tzf = TimezoneFinder()
+
+        return _tzf.timezone_at(lat=lat, lng=lon)
+
 class GeoapifyAPI():
     def __init__(self, api_url, api_key):
         self.__api_url = api_url
@@ -26,7 +42,7 @@ class GeoapifyAPI():
 
     def __get(self, url, params):
         path = urllib.parse.urlparse(url).path
-        r = requests.get(url, params)
+        r = transport.shared().get(url, params)
 
         if r.status_code == 200:
             l.debug(f"Geoapify API GET {path} => {r}")
@@ -65,6 +81,7 @@ class GeoapifyAPI():
     def get_timezone(self, street, city, state, postcode):
         ll = self.get_lat_lon(street, city, state, postcode)
 
-        tzf = TimezoneFinder()
+        return self.get_timezone_at(ll['lat'], ll['lon'])
 
-        return tzf.timezone_at(lat=ll['lat'], lng=ll['lon'])
+    def get_timezone_at(self, lat, lon):
+        return timezone_at(lat, lon)
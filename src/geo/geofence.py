@@ -0,0 +1,122 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import math
+import json
+import threading
+import logging
+
+from collections import OrderedDict
+
+l = logging.getLogger('helios')
+
+EARTH_RADIUS = 6371008.8
+
+def haversine(lat1, lon1, lat2, lon2):
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = math.radians(lat2 - lat1)
+    d_lambda = math.radians(lon2 - lon1)
+
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+class GeocodeCache():
+    def __init__(self, cache_file, max_entries=1024, precision=4):
+        self.__cache_file = cache_file
+        self.__max_entries = max_entries
+        self.__precision = precision
+
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+
+        self.__load()
+
+    def __load(self):
+        if self.__cache_file and os.path.exists(self.__cache_file):
+            try:
+                with open(self.__cache_file, 'r') as cache_store:
+                    for key, address in json.load(cache_store):
+                        self.__entries[key] = address
+            except (ValueError, TypeError) as err:
+                l.warning(f"Ignoring unreadable geocode cache '{self.__cache_file}' => {err}")
+                self.__entries.clear()
+
+    def __save(self):
+        if not self.__cache_file:
+            return
+
+        tmp_file = f"{self.__cache_file}.tmp"
+        with open(tmp_file, 'w') as cache_store:
+            json.dump(list(self.__entries.items()), cache_store)
+        os.replace(tmp_file, self.__cache_file)
+
+    def __key(self, lat, lon):
+        return f"{lat:.{self.__precision}f},{lon:.{self.__precision}f}"
+
+    def get(self, lat, lon):
+        key = self.__key(lat, lon)
+
+        with self.__lock:
+            if key not in self.__entries:
+                return None
+
+            self.__entries.move_to_end(key)
+
+            return self.__entries[key]
+
+    def put(self, lat, lon, address):
+        key = self.__key(lat, lon)
+
+        # Shared by every vehicle evaluation, and by every site in multi-site mode.
+        with self.__lock:
+            self.__entries[key] = address
+            self.__entries.move_to_end(key)
+
+            while len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+
+            self.__save()
+
+class Geofence():
+    def __init__(self, geoapify, home_street, home_ll, radius=100, margin=25, cache=None):
+        self.__geoapify = geoapify
+        self.__home_street = home_street
+        self.__home_ll = home_ll
+        self.__radius = radius
+        self.__margin = margin
+        self.__cache = cache
+
+    def distance(self, lat, lon):
+        return haversine(self.__home_ll['lat'], self.__home_ll['lon'], lat, lon)
+
+    def contains(self, lat, lon):
+        d = self.distance(lat, lon)
+
+        if d <= self.__radius - self.__margin:
+            return True
+        if d > self.__radius + self.__margin:
+            return False
+
+        l.debug(f"Vehicle is {int(d)}m from home, near the geofence edge, checking street address.")
+
+        street_address = None
+        if self.__cache:
+            street_address = self.__cache.get(lat, lon)
+
+        if street_address is None:
+            street_address = self.__geoapify.get_street_address(lat, lon)
+            if self.__cache:
+                self.__cache.put(lat, lon, street_address)
+
+        return street_address == self.__home_street
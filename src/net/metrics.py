@@ -0,0 +1,194 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import re
+import math
+import time
+import urllib
+import threading
+import logging
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+l = logging.getLogger('helios')
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metric():
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(k, '')) for k in self.labels)
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+    def expose(self):
+        lines = [ f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}" ]
+
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._sample_lines(key, value))
+
+        return lines
+
+    def _sample_lines(self, key, value):
+        return [ f"{self.name}{self._label_text(key)} {value:g}" ]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=(0.1, 0.5, 1, 5, 10, 30, 60)):
+        Metric.__init__(self, name, help, labels)
+
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def _sample_lines(self, key, value):
+        counts, total = value
+
+        lines = []
+        for bound, count in zip(self.buckets, counts):
+            le = '+Inf' if bound == math.inf else f"{bound:g}"
+            lines.append(f"{self.name}_bucket{self._label_text(key, [ ('le', le) ])} {count}")
+
+        lines.append(f"{self.name}_sum{self._label_text(key)} {total:g}")
+        lines.append(f"{self.name}_count{self._label_text(key)} {counts[-1]}")
+
+        return lines
+
+_registry = []
+
+def register(metric):
+    _registry.append(metric)
+
+    return metric
+
+def expose():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.expose())
+
+    return '\n'.join(lines) + '\n'
+
+API_SECONDS = register(Histogram('helios_api_request_seconds',
+    'Latency of Tesla, Enphase and Geoapify API requests.', ('service', 'method', 'endpoint'),
+    (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)))
+
+API_RESPONSES = register(Counter('helios_api_responses_total',
+    'API responses by status code, or exception name when no response was received.',
+    ('service', 'method', 'endpoint', 'status')))
+
+API_RETRIES = register(Counter('helios_api_retries_total',
+    'API requests retried, by the reason for the retry.', ('service', 'reason')))
+
+API_BACKOFF_SECONDS = register(Counter('helios_api_backoff_seconds_total',
+    'Time spent sleeping between API retries.', ('service',)))
+
+TESLA_WAKES = register(Counter('helios_tesla_wakes_total',
+    'Tesla wake ups by outcome.', ('vehicle', 'result')))
+
+TOKEN_REFRESHES = register(Counter('helios_token_refreshes_total',
+    'Auth token refreshes by status code, or exception name when no response was received.',
+    ('service', 'result')))
+
+LOOP_SECONDS = register(Histogram('helios_loop_iteration_seconds',
+    'Time from the start of a control loop iteration to its decision, excluding the wait for the next one.',
+    ('site', 'outcome'), (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)))
+
+AMP_TARGET = register(Gauge('helios_amp_target',
+    'Current charging amperage target, 0 when not charging from solar.', ('site',)))
+
+def endpoint(url):
+    path = urllib.parse.urlparse(url).path
+
+    # Keep label cardinality bounded, ids become a placeholder.
+    return re.sub(r'/(vehicles|systems)/\d+', r'/\1/{id}', path)
+
+def retry_sleep(service, reason, seconds):
+    API_RETRIES.inc(service=service, reason=reason)
+    API_BACKOFF_SECONDS.inc(seconds, service=service)
+
+    time.sleep(seconds)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        l.debug(f"{self.address_string()} - {format % args}")
+
+    def do_GET(self):
+        if urllib.parse.urlparse(self.path).path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = expose().encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+_lock = threading.Lock()
+_server = None
+
+def serve(address='127.0.0.1', port=9108):
+    global _server
+
+    with _lock:
+        if _server:
+            return _server
+
+        _server = ThreadingHTTPServer((address, port), MetricsHandler)
+        _server.daemon_threads = True
+
+        threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
+
+    l.info(f"Serving metrics on http://{address}:{port}/metrics")
+
+    return _server
@@ -0,0 +1,165 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import random
+import threading
+import logging
+import requests
+
+from net import metrics
+
+l = logging.getLogger('helios')
+
+class CircuitOpen(requests.exceptions.RequestException):
+    pass
+
+class CircuitBreaker():
+    def __init__(self, name, failure_threshold=5, reset_timeout=120):
+        self.__name = name
+        self.__failure_threshold = failure_threshold
+        self.__reset_timeout = reset_timeout
+
+        self.__lock = threading.Lock()
+        self.__failures = 0
+        self.__opened_at = None
+
+    def check(self):
+        with self.__lock:
+            if self.__opened_at is None:
+                return
+
+            # Once the timeout has passed a single request is let through to
+            # find out whether the endpoint has recovered, the next one waits
+            # for another timeout.
+            now = time.time()
+            if (now - self.__opened_at) >= self.__reset_timeout:
+                self.__opened_at = now
+                return
+
+            raise CircuitOpen(f"Circuit open for {self.__name}, failing fast.")
+
+    def success(self):
+        with self.__lock:
+            if self.__opened_at is not None:
+                l.info(f"Circuit for {self.__name} closed.")
+            self.__failures = 0
+            self.__opened_at = None
+
+    def failure(self):
+        with self.__lock:
+            self.__failures += 1
+
+            if self.__opened_at is not None:
+                self.__opened_at = time.time()
+            elif self.__failures >= self.__failure_threshold:
+                l.warning(f"Circuit for {self.__name} opened after {self.__failures} failures.")
+                self.__opened_at = time.time()
+
+class Attempts():
+    def __init__(self, service, breaker, deadline_at, critical, max_attempts, base_delay, max_delay):
+        self.__service = service
+        self.__breaker = breaker
+        self.__deadline_at = deadline_at
+        self.__critical = critical
+        self.__max_attempts = max_attempts
+        self.__base_delay = base_delay
+        self.__max_delay = max_delay
+
+        self.__retrying = False
+        self.__reason = None
+        self.__delay = None
+
+    def __iter__(self):
+        for attempt in range(self.__max_attempts):
+            # Safety actions, such as stopping a charge, are sent whatever
+            # state the endpoint is in.
+            if not self.__critical:
+                try:
+                    self.__breaker.check()
+                except CircuitOpen:
+                    if attempt == 0:
+                        raise
+                    return
+
+            self.__retrying = False
+            yield attempt
+
+            if not self.__retrying or attempt + 1 == self.__max_attempts:
+                return
+
+            delay = self.__delay
+            if delay is None:
+                delay = random.uniform(0, min(self.__max_delay, self.__base_delay * 2 ** attempt))
+
+            if time.time() + delay > self.__deadline_at:
+                l.warning(f"Giving up on {self.__service} request after {attempt + 1} attempt(s), deadline reached.")
+                return
+
+            metrics.retry_sleep(self.__service, self.__reason, delay)
+
+    def success(self):
+        self.__breaker.success()
+
+    def retry(self, reason, delay=None, fault=True):
+        # Faults count towards opening the circuit, errors that only concern
+        # this request, such as an expired token or a sleeping vehicle, do not.
+        if fault:
+            self.__breaker.failure()
+
+        self.__retrying = True
+        self.__reason = reason
+        self.__delay = delay
+
+_lock = threading.Lock()
+_breakers = {}
+_settings = { 'max_attempts'      : 10,
+              'base_delay'        : 1,
+              'max_delay'         : 60,
+              'failure_threshold' : 5,
+              'reset_timeout'     : 120,
+              'critical_deadline' : 60 }
+
+def configure(**kwargs):
+    _settings.update({ k : v for k, v in kwargs.items() if k in _settings })
+
+def critical_deadline():
+    return _settings['critical_deadline']
+
+def breaker(service, url, key=None):
+    # Endpoints are shared by every vehicle or system, a key keeps one that
+    # is failing from opening the circuit for all the others.
+    name = f"{service} {metrics.endpoint(url)}"
+    if key is not None:
+        name = f"{name} [{key}]"
+
+    with _lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, _settings['failure_threshold'], _settings['reset_timeout'])
+
+        return _breakers[name]
+
+class RetryPolicy():
+    def __init__(self, service, deadline=60):
+        self.__service = service
+        self.__deadline = deadline
+
+    def attempts(self, url, deadline=None, critical=False, max_attempts=None, key=None):
+        # A caller's own deadline is kept as it is, it may be what is left of
+        # a longer one.
+        if deadline is None:
+            deadline = self.__deadline
+            if critical:
+                deadline = max(deadline, _settings['critical_deadline'])
+
+        return Attempts(self.__service, breaker(self.__service, url, key), time.time() + deadline, critical,
+                        max_attempts or _settings['max_attempts'], _settings['base_delay'],
+                        _settings['max_delay'])
@@ -0,0 +1,215 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import tempfile
+import threading
+import logging
+import requests
+
+from net import metrics
+
+l = logging.getLogger('helios')
+
+class TokenError(Exception):
+    pass
+
+class TokenManager():
+    def __init__(self, service, token_file, grant, margin=900, lifetime=7200, attempts=5,
+                 retry_delay=60, max_retry_delay=900):
+        self.__service = service
+        self.__name = service.capitalize()
+        self.__token_file = token_file
+        self.__grant = grant
+        self.__margin = margin
+        self.__lifetime = lifetime
+        self.__attempts = attempts
+        self.__retry_delay = retry_delay
+        self.__max_retry_delay = max_retry_delay
+
+        self.__lock = threading.Lock()
+        self.__start_lock = threading.Lock()
+        self.__wake = threading.Event()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+        self.__tokens = None
+        self.__expires_at = 0
+
+    def set_grant(self, grant):
+        with self.__lock:
+            self.__grant = grant
+
+    def __set(self, tokens, issued):
+        with self.__lock:
+            self.__tokens = tokens
+            self.__expires_at = issued + (tokens.get('expires_in') or self.__lifetime)
+
+    def __load(self):
+        if not os.path.exists(self.__token_file):
+            return
+
+        l.debug(f"Found existing tokens in '{self.__token_file}'.")
+        with open(self.__token_file, 'r') as token_store:
+            tokens = json.load(token_store)
+
+        # The file is rewritten on every refresh, so it was issued when last modified.
+        self.__set(tokens, min(os.path.getmtime(self.__token_file), time.time()))
+
+    def __save(self, tokens):
+        # Several processes and interfaces read this file, never leave it half written.
+        fd, path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.__token_file)),
+                                    prefix='.tokens-')
+        try:
+            with os.fdopen(fd, 'w') as token_store:
+                json.dump(tokens, token_store)
+                token_store.flush()
+                os.fsync(token_store.fileno())
+            os.replace(path, self.__token_file)
+        except Exception:
+            if os.path.exists(path):
+                os.unlink(path)
+            raise
+
+    def __refresh(self):
+        with self.__lock:
+            tokens = self.__tokens
+
+        with self.__lock:
+            grant = self.__grant
+
+        try:
+            r = grant(tokens)
+        except requests.exceptions.RequestException as err:
+            l.error(f"Failed to refresh {self.__name} auth tokens => {err}")
+            metrics.TOKEN_REFRESHES.inc(service=self.__service, result=type(err).__name__)
+            return False
+
+        metrics.TOKEN_REFRESHES.inc(service=self.__service, result=r.status_code)
+
+        if r.status_code != 200:
+            l.error(f"Failed to refresh {self.__name} auth tokens => {r}")
+            return False
+
+        refreshed = dict(tokens or {})
+        refreshed.update(r.json())
+
+        self.__save(refreshed)
+        self.__set(refreshed, time.time())
+
+        l.info(f"Refreshed {self.__name} auth tokens.")
+
+        return True
+
+    def __valid(self):
+        with self.__lock:
+            return self.__tokens and 'access_token' in self.__tokens and time.time() < self.__expires_at
+
+    def __due(self):
+        with self.__lock:
+            return self.__expires_at - self.__margin
+
+    def acquire(self):
+        with self.__start_lock:
+            if self.__thread:
+                return
+
+            self.__load()
+
+            attempt = 1
+            while not self.__valid() and not self.__refresh():
+                if attempt >= self.__attempts:
+                    raise TokenError(f"Could not get {self.__name} auth tokens.")
+                metrics.retry_sleep(self.__service, 'token', 3 * attempt)
+                attempt += 1
+
+            self.__thread = threading.Thread(target=self.__run, name=f"{self.__service}-tokens", daemon=True)
+            self.__thread.start()
+
+    def __run(self):
+        delay = self.__retry_delay
+
+        while not self.__stop.is_set():
+            wait = self.__due() - time.time()
+            if wait > 0:
+                self.__wake.wait(wait)
+                self.__wake.clear()
+                continue
+
+            try:
+                refreshed = self.__refresh()
+            except Exception as err:
+                l.error(f"Failed to refresh {self.__name} auth tokens => {err}")
+                refreshed = False
+
+            if refreshed:
+                delay = self.__retry_delay
+                continue
+
+            # The current token is still served, and may well still be accepted.
+            self.__wake.wait(delay)
+            self.__wake.clear()
+            delay = min(delay * 2, self.__max_retry_delay)
+
+    def stop(self):
+        self.__stop.set()
+        self.__wake.set()
+
+    def headers(self):
+        with self.__lock:
+            return { 'Authorization' : f"Bearer {self.__tokens['access_token']}" }
+
+    def expire(self, headers=None):
+        # Called on a 401, many requests may fail with the same token but only the
+        # first needs to trigger a refresh.
+        with self.__lock:
+            if headers and headers.get('Authorization') != f"Bearer {self.__tokens['access_token']}":
+                return
+            self.__expires_at = min(self.__expires_at, time.time())
+
+        self.__wake.set()
+
+_lock = threading.Lock()
+_managers = {}
+_users = {}
+
+def manager(service, token_file, grant, **kwargs):
+    path = os.path.abspath(token_file)
+
+    with _lock:
+        if path not in _managers:
+            _managers[path] = TokenManager(service, path, grant, **kwargs)
+        else:
+            # A rebuilt interface may bring new client credentials.
+            _managers[path].set_grant(grant)
+
+        _users[path] = _users.get(path, 0) + 1
+
+        return _managers[path]
+
+def release(manager):
+    # The refresh thread is stopped once nothing uses the tokens any more, a
+    # rebuilt interface picks the manager up again before the old one lets go.
+    with _lock:
+        path = next((p for p, m in _managers.items() if m is manager), None)
+        if path is None:
+            return
+
+        _users[path] -= 1
+        if _users[path] > 0:
+            return
+
+        del _managers[path]
+        del _users[path]
+
+    manager.stop()
@@ -0,0 +1,116 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import threading
+import logging
+import urllib
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from net import metrics
+
+l = logging.getLogger('helios')
+
+class Transport():
+    def __init__(self, pool_connections=4, pool_maxsize=8, connect_timeout=5, read_timeout=30):
+        self.__timeout = (connect_timeout, read_timeout)
+
+        # Retries are handled by the API classes, the adapter only pools connections.
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                              max_retries=0)
+
+        self.__session = requests.Session()
+        self.__session.mount('https://', adapter)
+        self.__session.mount('http://', adapter)
+
+    def __measure(self, method, url, request):
+        labels = { 'service'  : service_name(url),
+                   'method'   : method,
+                   'endpoint' : metrics.endpoint(url) }
+
+        start = time.monotonic()
+        try:
+            r = request()
+        except requests.exceptions.RequestException as err:
+            metrics.API_SECONDS.observe(time.monotonic() - start, **labels)
+            metrics.API_RESPONSES.inc(status=type(err).__name__, **labels)
+            raise
+
+        metrics.API_SECONDS.observe(time.monotonic() - start, **labels)
+        metrics.API_RESPONSES.inc(status=r.status_code, **labels)
+
+        return r
+
+    def get(self, url, params=None, headers=None, timeout=None, verify=True):
+        return self.__measure('GET', url,
+                              lambda: self.__session.get(url, params=params, headers=headers,
+                                                         timeout=timeout or self.__timeout, verify=verify))
+
+    def post(self, url, data=None, headers=None, timeout=None, verify=True):
+        return self.__measure('POST', url,
+                              lambda: self.__session.post(url, data=data, headers=headers,
+                                                          timeout=timeout or self.__timeout, verify=verify))
+
+    def close(self):
+        self.__session.close()
+
+def service_name(url):
+    parsed = urllib.parse.urlparse(url)
+
+    for service in ( 'tesla', 'enphase', 'envoy', 'geoapify' ):
+        if service in parsed.hostname:
+            return service
+
+    # Stand-in servers share one host, fall back to the API path layout.
+    if parsed.path.startswith(('/api/1/', '/oauth2/')):
+        return 'tesla'
+    if parsed.path.startswith(('/api/v4/', '/oauth/')):
+        return 'enphase'
+    if parsed.path.startswith('/v1/'):
+        return 'geoapify'
+    if parsed.path.startswith(('/envoy/', '/ivp/')):
+        return 'envoy'
+
+    return parsed.hostname
+
+_lock = threading.Lock()
+_shared = None
+
+def configure(**settings):
+    global _shared
+
+    # The previous transport is not closed, requests still in flight on other
+    # threads finish on it and its pools are released once it is unreferenced.
+    with _lock:
+        _shared = Transport(**settings)
+
+    l.debug(f"Configured HTTP transport: {settings}")
+
+    return _shared
+
+def install(t):
+    global _shared
+
+    with _lock:
+        _shared = t
+
+    return _shared
+
+def shared():
+    global _shared
+
+    with _lock:
+        if not _shared:
+            _shared = Transport()
+
+        return _shared
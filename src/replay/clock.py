@@ -0,0 +1,49 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import threading
+
+from replay.trace import TraceExhausted
+
+class VirtualClock():
+    def __init__(self, start, end=None):
+        self.__now = start
+        self.__end = end
+        self.__exhausted = False
+        self.__lock = threading.Lock()
+
+        self.__real_time = time.time
+        self.__real_sleep = time.sleep
+
+    def install(self):
+        time.time = self.time
+        time.sleep = self.sleep
+
+    def uninstall(self):
+        time.time = self.__real_time
+        time.sleep = self.__real_sleep
+
+    def exhausted(self):
+        return self.__exhausted
+
+    def time(self):
+        with self.__lock:
+            return self.__now
+
+    def sleep(self, seconds):
+        with self.__lock:
+            self.__now += max(seconds, 0)
+            now = self.__now
+
+        if self.__end and now > self.__end:
+            self.__exhausted = True
+            raise TraceExhausted(f"Virtual time {time.ctime(now)} is past the end of the trace.")
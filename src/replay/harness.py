@@ -0,0 +1,117 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import copy
+import json
+import time
+import atexit
+import shutil
+import tempfile
+import logging
+
+from replay.trace import load_trace, ReplayTransport
+from replay.clock import VirtualClock
+
+l = logging.getLogger('helios')
+
+class ReplayHarness():
+    def __init__(self, trace_file):
+        entries = load_trace(trace_file)
+        if len(entries) == 0:
+            raise ValueError(f"Trace file '{trace_file}' is empty.")
+
+        self.clock = VirtualClock(entries[0]['t'], entries[-1]['t'])
+        self.transport = ReplayTransport(entries, self.clock)
+
+        self.__cwd = None
+        self.__workdir = None
+        self.__decisions = []
+        self.__iterations = []
+        self.__iteration_start = None
+        self.__calls_at_decision = {}
+
+    def isolate(self, c):
+        # Replays run in a scratch directory so token files, telemetry stores and
+        # caches start cold and nothing real is overwritten with recorded data.
+        self.__cwd = os.getcwd()
+        self.__workdir = tempfile.mkdtemp(prefix='helios-replay-')
+        os.chdir(self.__workdir)
+        atexit.register(self.cleanup)
+
+        c = copy.deepcopy(c)
+        for section in ( 'enphase', 'tesla', 'geoapify', 'bootstrap' ):
+            for key in c.get(section, {}):
+                if key.endswith('_file'):
+                    c[section][key] = os.path.basename(c[section][key])
+
+        # Tokens still valid when recording were reused, so the trace need not
+        # hold a token request.
+        for section in ( 'enphase', 'tesla' ):
+            with open(c[section]['token_file'], 'w') as token_store:
+                json.dump({ 'access_token' : 'REPLAY', 'refresh_token' : 'REPLAY' }, token_store)
+
+        l.info(f"Replaying in {self.__workdir}.")
+
+        return c
+
+    def cleanup(self):
+        if not self.__workdir:
+            return
+
+        os.chdir(self.__cwd)
+        shutil.rmtree(self.__workdir, ignore_errors=True)
+        self.__workdir = None
+
+    def install(self):
+        self.clock.install()
+
+    def exhausted(self):
+        return self.clock.exhausted()
+
+    def iteration(self):
+        now = time.perf_counter()
+        if self.__iteration_start is not None:
+            self.__iterations.append(now - self.__iteration_start)
+        self.__iteration_start = now
+
+    def decision(self, amps):
+        calls = self.transport.get_calls()
+        delta = { k : v - self.__calls_at_decision.get(k, 0) for k, v in calls.items() }
+        self.__calls_at_decision = calls
+
+        self.__decisions.append({ 't' : self.clock.time(), 'amps' : amps, 'calls' : delta })
+
+    def report(self):
+        print("")
+        print("Replay decisions:")
+        for d in self.__decisions:
+            calls = ', '.join(f"{k}={v}" for k, v in sorted(d['calls'].items()))
+            print(f"  {time.ctime(d['t'])}  amps={d['amps']}  calls: {calls}")
+
+        print("")
+        count = len(self.__decisions)
+        calls = self.transport.get_calls()
+        total = sum(calls.values())
+        print(f"Decisions: {count}")
+        print(f"API calls: {total} ({', '.join(f'{k}={v}' for k, v in sorted(calls.items()))})")
+        if count:
+            print(f"API calls per decision: {total / count:.1f}")
+        # The last iteration ran up to the sleep that went past the trace.
+        iterations = list(self.__iterations)
+        if self.__iteration_start is not None:
+            iterations.append(time.perf_counter() - self.__iteration_start)
+        if iterations:
+            print(f"Wall time per loop iteration: mean {1000 * sum(iterations) / len(iterations):.1f} ms, "
+                  f"max {1000 * max(iterations):.1f} ms over {len(iterations)} iteration(s)")
+        else:
+            print("Wall time per loop iteration: no iterations ran")
+        print("")
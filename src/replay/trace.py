@@ -0,0 +1,183 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import copy
+import bisect
+import json
+import time
+import urllib
+import threading
+import logging
+import requests
+
+from net.transport import service_name
+
+l = logging.getLogger('helios')
+
+SECRET_PARAMS = ( 'key', 'apiKey', 'api_key' )
+SECRET_FIELDS = ( 'access_token', 'refresh_token', 'id_token' )
+
+class TraceExhausted(Exception):
+    pass
+
+def redact_url(url):
+    parsed = urllib.parse.urlparse(url)
+    query = [ (k, 'REDACTED' if k in SECRET_PARAMS else v)
+              for k, v in urllib.parse.parse_qsl(parsed.query) ]
+
+    return parsed._replace(query=urllib.parse.urlencode(query)).geturl()
+
+def redact(data):
+    if isinstance(data, dict):
+        return { k : 'REDACTED' if k in SECRET_FIELDS else redact(v) for k, v in data.items() }
+    if isinstance(data, list):
+        return [ redact(v) for v in data ]
+
+    return data
+
+class TraceResponse():
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.__data = data
+
+    def json(self):
+        if self.__data is None:
+            raise ValueError("Recorded response has no JSON body.")
+
+        return copy.deepcopy(self.__data)
+
+    def __repr__(self):
+        return f"<Response [{self.status_code}]>"
+
+class RecordingTransport():
+    def __init__(self, transport, trace_file):
+        self.__transport = transport
+        self.__trace_file = trace_file
+        self.__lock = threading.Lock()
+
+    def __record(self, method, url, params, r=None, err=None):
+        entry = { 't'      : time.time(),
+                  'method' : method,
+                  'url'    : redact_url(url),
+                  'params' : redact(params) }
+
+        if err is not None:
+            entry['error'] = type(err).__name__
+        else:
+            entry['status'] = r.status_code
+            try:
+                entry['json'] = redact(r.json())
+            except ValueError:
+                entry['json'] = None
+
+        with self.__lock, open(self.__trace_file, 'a') as trace:
+            trace.write(json.dumps(entry) + '\n')
+
+    def __call(self, method, url, params, request):
+        try:
+            r = request()
+        except requests.exceptions.RequestException as err:
+            self.__record(method, url, params, err=err)
+            raise
+
+        self.__record(method, url, params, r)
+
+        return r
+
+    def get(self, url, params=None, headers=None, timeout=None, verify=True):
+        return self.__call('GET', url, params,
+                           lambda: self.__transport.get(url, params, headers=headers, timeout=timeout,
+                                                        verify=verify))
+
+    def post(self, url, data=None, headers=None, timeout=None, verify=True):
+        return self.__call('POST', url, None,
+                           lambda: self.__transport.post(url, data, headers=headers, timeout=timeout,
+                                                         verify=verify))
+
+def load_trace(trace_file):
+    entries = []
+    with open(trace_file, 'r') as trace:
+        for line in trace:
+            if line.strip():
+                entries.append(json.loads(line))
+
+    return entries
+
+def signature(url, params=None):
+    query = urllib.parse.parse_qsl(urllib.parse.urlparse(url).query) + list((params or {}).items())
+
+    return urllib.parse.urlencode(sorted((k, str(v)) for k, v in query if k not in SECRET_PARAMS))
+
+class ReplayTransport():
+    def __init__(self, entries, clock):
+        self.__clock = clock
+        self.__lock = threading.Lock()
+
+        self.__entries = {}
+        self.__signed = {}
+        for entry in entries:
+            key = (entry['method'], urllib.parse.urlparse(entry['url']).path)
+            self.__entries.setdefault(key, []).append(entry)
+            self.__signed.setdefault(key + (signature(entry['url'], entry['params']),), []).append(entry)
+
+        self.__positions = {}
+        self.__calls = {}
+
+    def get_calls(self):
+        with self.__lock:
+            return dict(self.__calls)
+
+    def __latest(self, entries, now):
+        times = [ entry['t'] for entry in entries ]
+
+        return entries[max(bisect.bisect_right(times, now) - 1, 0)]
+
+    def __serve(self, method, url, params=None):
+        key = (method, urllib.parse.urlparse(url).path)
+        service = service_name(url)
+
+        with self.__lock:
+            self.__calls[service] = self.__calls.get(service, 0) + 1
+
+            if key not in self.__entries:
+                raise requests.exceptions.ConnectionError(f"{method} {key[1]} is not in the trace.")
+
+            now = self.__clock.time()
+
+            # A request recorded with the same parameters, such as the next page
+            # of a telemetry backfill, is the best match. Otherwise serve the
+            # latest response recorded at or before the virtual time, so a
+            # controller polling more or less often than the recorded one still
+            # sees the data that was current at that moment.
+            signed = self.__signed.get(key + (signature(url, params),))
+            if signed:
+                entry = self.__latest(signed, now)
+            else:
+                entries = self.__entries[key]
+                pos = self.__positions.get(key, 0)
+                while pos + 1 < len(entries) and entries[pos + 1]['t'] <= now:
+                    pos += 1
+                self.__positions[key] = pos
+
+                entry = entries[pos]
+
+        if 'error' in entry:
+            if entry['error'] in ( 'Timeout', 'ReadTimeout', 'ConnectTimeout' ):
+                raise requests.exceptions.Timeout(f"Recorded {entry['error']}")
+            raise requests.exceptions.ConnectionError(f"Recorded {entry['error']}")
+
+        return TraceResponse(entry['status'], entry['json'])
+
+    def get(self, url, params=None, headers=None, timeout=None, verify=True):
+        return self.__serve('GET', url, params)
+
+    def post(self, url, data=None, headers=None, timeout=None, verify=True):
+        return self.__serve('POST', url)
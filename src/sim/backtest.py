@@ -0,0 +1,244 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import math
+import itertools
+import functools
+import logging
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+from solar.generation import local_time
+from solar.store import TelemetryStore
+from vehicles.sessions import SessionLog
+
+l = logging.getLogger('helios')
+
+INTERVAL = 900
+VOLTAGE = 240
+
+DEFAULTS = { 'mode'                 : 'open_loop',
+             'reserved_power'       : 1000,
+             'home_battery'         : 95,
+             'min_amps'             : 5,
+             'kp'                   : 0.3,
+             'ki'                   : 0.7,
+             'deadband'             : 150,
+             'hysteresis'           : 2,
+             'min_command_interval' : 300,
+             'max_amps'             : 80,
+             'battery_capacity'     : 13500,
+             'battery_rate'         : 5000,
+             'battery_floor'        : 10,
+             'vehicle_kwh'          : 20,
+             'vehicle_max_amps'     : 48,
+             'arrive_hour'          : 0,
+             'depart_hour'          : 24 }
+
+RESULTS = ( 'solar_kwh', 'grid_kwh', 'export_kwh', 'ev_kwh', 'commands' )
+
+def recorded_ev(decisions, end_at, max_hold=2 * INTERVAL):
+    # Each allocation was held until the next decision, or for a couple of
+    # intervals when there was none, so the energy the vehicles drew up to any
+    # moment is the integral of that step function.
+    energy = np.zeros(len(end_at))
+    if len(decisions) == 0 or len(end_at) == 0:
+        return energy
+
+    starts = np.array([ d['t'] for d in decisions ], dtype=np.float64)
+    power = np.array([ d['allocated'] or 0 for d in decisions ], dtype=np.float64) * VOLTAGE
+    lengths = np.minimum(np.append(np.diff(starts), np.inf), max_hold)
+    before = np.concatenate(([0], np.cumsum(power * lengths / 3600)[:-1]))
+
+    def drawn(t):
+        k = np.searchsorted(starts, t, side='right') - 1
+        j = np.maximum(k, 0)
+        return np.where(k >= 0, before[j] + power[j] * np.clip(t - starts[j], 0, lengths[j]) / 3600, 0)
+
+    return drawn(end_at) - drawn(end_at - INTERVAL)
+
+def load_intervals(store_file, tz, since=0, until=None, session_file=None):
+    # The recorded files are only read, a backtest never changes them.
+    store = TelemetryStore(store_file, INTERVAL, read_only=True)
+
+    meters = store.meter_series(since, until, INTERVAL)
+    battery = store.series('battery', since, until, INTERVAL)
+    store.close()
+
+    end_at = meters['end_time']
+    local = local_time(end_at, tz) if len(end_at) else end_at
+
+    # The recorded consumption includes whatever the vehicles drew while it was
+    # recorded, the simulated vehicle takes its place.
+    consumed = meters.energy('consumed')
+    if session_file:
+        session_log = SessionLog(session_file, read_only=True)
+        ev = recorded_ev(session_log.decisions(since - 2 * INTERVAL, until), end_at)
+        session_log.close()
+        l.info(f"Removing {ev.sum() / 1000:.1f} kWh of recorded vehicle charging from the consumption.")
+        consumed = np.maximum(consumed - ev, 0)
+
+    return { 'end_at'   : end_at,
+             'produced' : meters.energy('produced'),
+             'consumed' : consumed,
+             'hour'     : (local // 3600) % 24,
+             'day'      : local // 86400,
+             'soc'      : battery['soc'][0] if len(battery) else 50 }
+
+def parse_values(spec):
+    def value(v):
+        for kind in ( int, float ):
+            try:
+                return kind(v)
+            except ValueError:
+                pass
+        return v
+
+    if ':' in spec:
+        start, stop, step = ( float(v) for v in spec.split(':') )
+        values = [ round(v, 6) for v in np.arange(start, stop + step / 2, step) ]
+        return [ int(v) if v == int(v) else v for v in values ]
+
+    return [ value(v) for v in spec.split(',') ]
+
+def expand_grid(base, grid):
+    names = list(grid)
+
+    return [ dict(base, **dict(zip(names, values))) for values in itertools.product(*grid.values()) ]
+
+def run(series, configs):
+    # Every configuration is stepped through the intervals together, the
+    # policy feeds back on itself over time but is independent across them.
+    n = len(configs)
+    p = { k : np.array([ c.get(k, DEFAULTS[k]) for c in configs ]) for k in DEFAULTS }
+
+    pi = p['mode'] == 'pi'
+    reserved = p['reserved_power'].astype(np.float64)
+    max_power = p['max_amps'] * VOLTAGE
+    capacity = p['battery_capacity'].astype(np.float64)
+    step_rate = p['battery_rate'] / (3600 / INTERVAL)
+    to_power = 3600 / INTERVAL
+
+    arrive = p['arrive_hour']
+    depart = p['depart_hour']
+
+    soc = np.full(n, float(series['soc']))
+    need = np.zeros(n)
+    applied = np.zeros(n, dtype=np.int64)
+
+    exported = np.zeros(n)
+    charged = np.zeros(n)
+
+    integral = np.full(n, np.nan)
+    pi_target = np.zeros(n, dtype=np.int64)
+    changed_at = np.full(n, -np.inf)
+
+    totals = { k : np.zeros(n) for k in RESULTS }
+
+    produced = series['produced']
+    consumed = series['consumed']
+
+    for i in range(len(produced)):
+        t = series['end_at'][i]
+        hour = series['hour'][i]
+
+        if i == 0 or series['day'][i] != series['day'][i - 1]:
+            need[:] = p['vehicle_kwh'] * 1000
+
+        # Decisions are made on the interval before, as Amperage sees it.
+        target = np.zeros(n, dtype=np.int64)
+        if i > 0:
+            ok = soc.astype(np.int64) >= p['home_battery']
+            produced_prior = produced[i - 1] * to_power
+
+            ratio = 1.0
+            if i > 1 and produced[i - 2]:
+                ratio = produced[i - 1] / produced[i - 2]
+
+            surplus = applied * VOLTAGE + charged + exported
+            power_target = surplus * ratio - reserved
+            power_target = np.where(power_target > produced_prior, produced_prior - reserved, power_target)
+            open_loop = power_target / 244
+            open_loop = np.where(open_loop >= 5, open_loop, 0).astype(np.int64)
+
+            error = exported + charged - reserved
+            error = np.where(np.abs(error) > p['deadband'], error, 0)
+            integral = np.where(np.isnan(integral), applied * VOLTAGE, integral)
+            integral = np.clip(integral + p['ki'] * error, 0, max_power)
+            amps = (np.clip(integral + p['kp'] * error, 0, max_power) / VOLTAGE).astype(np.int64)
+
+            held = np.where(amps < p['min_amps'] - p['hysteresis'], 0,
+                            np.where(np.abs(amps - pi_target) < p['hysteresis'], pi_target,
+                                     np.maximum(amps, p['min_amps'])))
+            held = np.where(pi_target > 0, held, np.where(amps >= p['min_amps'], amps, 0))
+
+            limited = (held > pi_target) & ((t - changed_at) < p['min_command_interval'])
+            held = np.where(limited, pi_target, held)
+            changed_at = np.where(held != pi_target, t, changed_at)
+            pi_target = held
+
+            # A low house battery resets the controller.
+            reset = pi & ~ok
+            integral = np.where(reset, np.nan, integral)
+            pi_target = np.where(reset, 0, pi_target)
+            changed_at = np.where(reset, -np.inf, changed_at)
+
+            target = np.where(ok, np.where(pi, pi_target, open_loop), 0)
+
+        plugged = np.where(arrive <= depart, (hour >= arrive) & (hour < depart), (hour >= arrive) | (hour < depart))
+        amps = np.where(plugged & (need > 0), np.minimum(target, p['vehicle_max_amps']), 0)
+        amps = np.where(amps >= p['min_amps'], amps, 0)
+
+        starts = (applied == 0) & (amps > 0)
+        totals['commands'] += np.where(starts, 2, (amps != applied).astype(np.int64))
+
+        # Anti-windup, as PIControl.set_applied.
+        integral = np.where(~np.isnan(integral) & (pi_target > 0) & (amps < pi_target),
+                            np.minimum(integral, amps * VOLTAGE), integral)
+        applied = amps
+
+        ev = np.minimum(applied * VOLTAGE / to_power, need)
+        need -= ev
+
+        load = consumed[i] + ev
+        net = produced[i] - load
+        charge = np.clip(net, 0, np.minimum(step_rate, capacity * (100 - soc) / 100))
+        discharge = np.clip(-net, 0, np.minimum(step_rate, capacity * np.maximum(soc - p['battery_floor'], 0) / 100))
+        soc = soc + 100 * (charge - discharge) / capacity
+
+        totals['solar_kwh'] += np.minimum(ev, max(produced[i] - consumed[i], 0)) / 1000
+        totals['ev_kwh'] += ev / 1000
+        totals['export_kwh'] += np.maximum(net - charge, 0) / 1000
+        totals['grid_kwh'] += np.maximum(-net - discharge, 0) / 1000
+
+        exported = net * to_power
+        charged = charge * to_power
+
+    for k in RESULTS:
+        totals[k] = totals[k].round(3)
+    totals['commands'] = totals['commands'].astype(np.int64)
+
+    return [ dict(c, **{ k : totals[k][j].item() for k in RESULTS }) for j, c in enumerate(configs) ]
+
+def sweep(series, configs, workers=None, chunk_size=1024):
+    workers = workers or 1
+    chunk_size = max(1, min(chunk_size, math.ceil(len(configs) / workers)))
+    chunks = [ configs[i:i + chunk_size] for i in range(0, len(configs), chunk_size) ]
+
+    l.info(f"Backtesting {len(configs)} configurations over {len(series['end_at'])} intervals "
+           f"in {len(chunks)} chunks ...")
+
+    if workers == 1:
+        return [ r for chunk in chunks for r in run(series, chunk) ]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return [ r for results in pool.map(functools.partial(run, series), chunks) for r in results ]
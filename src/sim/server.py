@@ -0,0 +1,274 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import re
+import json
+import time
+import random
+import urllib
+import threading
+import logging
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+l = logging.getLogger('helios')
+
+class Faults():
+    def __init__(self, latency='fixed:0', error_rate=0.0, error_codes=(401, 408, 422, 503), seed=None):
+        self.__latency = self.__parse_latency(latency)
+        self.__error_rate = error_rate
+        self.__error_codes = error_codes
+
+        self.__lock = threading.Lock()
+        self.__rng = random.Random(seed)
+
+    def __parse_latency(self, spec):
+        kind, _, args = spec.partition(':')
+        args = [ float(a) for a in args.split(',') if a ]
+
+        if kind == 'fixed':
+            return lambda rng: args[0] if args else 0.0
+        if kind == 'uniform':
+            return lambda rng: rng.uniform(args[0], args[1])
+        if kind == 'lognormal':
+            return lambda rng: rng.lognormvariate(args[0], args[1])
+        if kind == 'exponential':
+            return lambda rng: rng.expovariate(1 / args[0])
+
+        raise ValueError(f"Unknown latency distribution '{spec}'.")
+
+    def delay(self):
+        with self.__lock:
+            return self.__latency(self.__rng)
+
+    def error(self):
+        with self.__lock:
+            if self.__error_codes and self.__rng.random() < self.__error_rate:
+                return self.__rng.choice(self.__error_codes)
+
+        return None
+
+class SimHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    routes = [ ( 'POST', r'/oauth2/v3/token',                               'tesla_token' ),
+               ( 'GET',  r'/api/1/vehicles',                                'tesla_vehicles' ),
+               ( 'GET',  r'/api/1/vehicles/(\d+)/vehicle_data',             'tesla_vehicle_data' ),
+               ( 'POST', r'/api/1/vehicles/(\d+)/wake_up',                  'tesla_wake_up' ),
+               ( 'POST', r'/api/1/vehicles/(\d+)/command/(\w+)',            'tesla_command' ),
+               ( 'POST', r'/oauth/token',                                   'enphase_token' ),
+               ( 'GET',  r'/api/v4/systems/(\d+)/telemetry/(\w+)',          'enphase_telemetry' ),
+               ( 'GET',  r'/envoy/(\d+)/ivp/livedata/status',               'envoy_status' ),
+               ( 'POST', r'/envoy/(\d+)/ivp/livedata/stream',               'envoy_stream' ),
+               ( 'GET',  r'/v1/geocode/search',                             'geocode_search' ),
+               ( 'GET',  r'/v1/geocode/reverse',                            'geocode_reverse' ) ]
+
+    def log_message(self, format, *args):
+        l.debug(f"{self.address_string()} - {format % args}")
+
+    def __reply(self, status, data):
+        body = json.dumps(data).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        raw = self.rfile.read(length).decode() if length else ''
+
+        try:
+            return json.loads(raw) if raw else {}
+        except ValueError:
+            return dict(urllib.parse.parse_qsl(raw))
+
+    def __dispatch(self, method):
+        parsed = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+        body = self.__body() if method == 'POST' else {}
+
+        for route_method, pattern, name in self.routes:
+            match = re.fullmatch(pattern, parsed.path)
+            if route_method == method and match:
+                break
+        else:
+            return self.__reply(404, { 'error' : f"No route for {method} {parsed.path}" })
+
+        time.sleep(self.server.faults.delay())
+
+        # Token endpoints live on separate auth servers upstream, faults are only
+        # injected into the APIs themselves.
+        status = None if name.endswith('_token') else self.server.faults.error()
+        if status:
+            return self.__reply(status, { 'response' : None, 'error' : f"injected {status}" })
+
+        world = self.server.world
+        with world.lock:
+            now = world.tick()
+            status, data = getattr(self, f"_{name}")(world, now, query, body, *match.groups())
+
+        self.__reply(status, data)
+
+    def do_GET(self):
+        self.__dispatch('GET')
+
+    def do_POST(self):
+        self.__dispatch('POST')
+
+    def __account(self):
+        m = re.search(r'sim-(\d+)', self.headers.get('Authorization', ''))
+
+        return int(m.group(1)) if m else 1
+
+    def _tesla_token(self, world, now, query, body):
+        m = re.search(r'sim-(\d+)', body.get('refresh_token', ''))
+        account = m.group(1) if m else '1'
+
+        return 200, { 'access_token'  : f"sim-{account}-{int(now)}",
+                      'refresh_token' : f"sim-{account}",
+                      'expires_in'    : 28800,
+                      'token_type'    : 'Bearer' }
+
+    def _tesla_vehicles(self, world, now, query, body):
+        vehicles = [ v.listing() for v in world.vehicles.values() if v.account == self.__account() ]
+
+        return 200, { 'response' : vehicles, 'count' : len(vehicles) }
+
+    def __vehicle(self, world, vehicle_id):
+        vehicle = world.vehicles.get(int(vehicle_id))
+        if not vehicle or vehicle.account != self.__account():
+            return None
+
+        return vehicle
+
+    def _tesla_vehicle_data(self, world, now, query, body, vehicle_id):
+        vehicle = self.__vehicle(world, vehicle_id)
+        if not vehicle:
+            return 404, { 'response' : None, 'error' : 'not_found' }
+        if vehicle.state != 'online':
+            return 408, { 'response' : None, 'error' : 'vehicle unavailable: vehicle is offline or asleep' }
+
+        vehicle.touch(now)
+
+        return 200, { 'response' : vehicle.vehicle_data() }
+
+    def _tesla_wake_up(self, world, now, query, body, vehicle_id):
+        vehicle = self.__vehicle(world, vehicle_id)
+        if not vehicle:
+            return 404, { 'response' : None, 'error' : 'not_found' }
+
+        vehicle.wake(now, world.wake_delay)
+
+        return 200, { 'response' : vehicle.listing() }
+
+    def _tesla_command(self, world, now, query, body, vehicle_id, command):
+        vehicle = self.__vehicle(world, vehicle_id)
+        if not vehicle:
+            return 404, { 'response' : None, 'error' : 'not_found' }
+        if vehicle.state != 'online':
+            return 408, { 'response' : None, 'error' : 'vehicle unavailable: vehicle is offline or asleep' }
+
+        vehicle.touch(now)
+
+        result = True
+        reason = ''
+        if command == 'set_charging_amps':
+            vehicle.amps = max(0, min(int(body.get('charging_amps', vehicle.amps)), vehicle.amps_max))
+        elif command == 'charge_start':
+            if vehicle.charging:
+                result, reason = False, 'is_charging'
+            elif not vehicle.plugged:
+                result, reason = False, 'disconnected'
+            elif vehicle.battery_level >= vehicle.charge_limit_soc:
+                result, reason = False, 'complete'
+            else:
+                vehicle.charging = True
+        elif command == 'charge_stop':
+            if not vehicle.charging:
+                result, reason = False, 'not_charging'
+            vehicle.charging = False
+        else:
+            return 404, { 'response' : None, 'error' : f"unknown command {command}" }
+
+        return 200, { 'response' : { 'result' : result, 'reason' : reason } }
+
+    def _enphase_token(self, world, now, query, body):
+        return 200, { 'access_token'  : f"enphase-{int(now)}",
+                      'refresh_token' : 'enphase',
+                      'token_type'    : 'bearer',
+                      'expires_in'    : 86400 }
+
+    def _enphase_telemetry(self, world, now, query, body, system_id, meter):
+        site = world.sites.get(int(system_id))
+        if not site or meter not in ( 'production_meter', 'consumption_meter', 'battery' ):
+            return 404, { 'message' : 'Not Found' }
+
+        start_at = int(query.get('start_at', now - 86400))
+
+        return 200, site.telemetry(meter, start_at, world.published_until(now))
+
+    def _envoy_status(self, world, now, query, body, system_id):
+        site = world.sites.get(int(system_id))
+        if not site:
+            return 404, { 'message' : 'Not Found' }
+
+        streaming = now < site.stream_until
+        live = site.live(now) if streaming else { k : 0.0 for k in ( 'pv', 'load', 'storage', 'grid' ) }
+
+        meters = { 'last_update' : int(now),
+                   'soc'         : int(site.soc),
+                   'enc_agg_soc' : int(site.soc) }
+        for meter, power in live.items():
+            meters[meter] = { 'agg_p_mw' : int(power * 1000) }
+
+        return 200, { 'connection' : { 'sc_stream' : 'enabled' if streaming else 'disabled' },
+                      'meters'     : meters }
+
+    def _envoy_stream(self, world, now, query, body, system_id):
+        site = world.sites.get(int(system_id))
+        if not site:
+            return 404, { 'message' : 'Not Found' }
+
+        # The real gateway stops streaming a few minutes after being asked.
+        if int(body.get('enable', 0)):
+            site.stream_until = now + 300
+
+        return 200, { 'sc_stream' : 'enabled' if now < site.stream_until else 'disabled' }
+
+    def _geocode_search(self, world, now, query, body):
+        site = world.site_for_street(query.get('street'))
+
+        return 200, { 'features' : [ { 'properties' : { 'lat'           : site.lat,
+                                                        'lon'           : site.lon,
+                                                        'address_line1' : site.street } } ] }
+
+    def _geocode_reverse(self, world, now, query, body):
+        street = world.street_at(float(query['lat']), float(query['lon']))
+
+        return 200, { 'features' : [ { 'properties' : { 'lat'           : float(query['lat']),
+                                                        'lon'           : float(query['lon']),
+                                                        'address_line1' : street } } ] }
+
+class SimServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, world, faults, handler=SimHandler):
+        ThreadingHTTPServer.__init__(self, address, handler)
+
+        self.world = world
+        self.faults = faults
+
+    def base_url(self):
+        host, port = self.server_address[:2]
+
+        return f"http://{host}:{port}"
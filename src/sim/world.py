@@ -0,0 +1,282 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import math
+import time
+import zlib
+import random
+import threading
+
+INTERVAL = 900
+
+HOME_LAT = 34.0522
+HOME_LON = -118.2437
+
+def noise(*key):
+    return random.Random(zlib.crc32(repr(key).encode())).random()
+
+def distance(lat1, lon1, lat2, lon2):
+    # Equirectangular is plenty at neighbourhood scale.
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+
+    return 6371008.8 * math.hypot(x, y)
+
+class SimVehicle():
+    def __init__(self, vehicle_id, account, display_name, home, rng, now, asleep=False, away=False):
+        self.id = vehicle_id
+        self.account = account
+        self.display_name = display_name
+
+        self.state = 'asleep' if asleep else 'online'
+        self.awake_at = None
+        self.last_activity = now
+        self.last_update = now
+
+        self.capacity = 75.0
+        self.battery_level = rng.uniform(30, 75)
+        self.charge_limit_soc = 80
+        self.charge_energy_added = 0.0
+        self.amps = 32
+        self.amps_max = 48
+        self.plugged = rng.random() < 0.8
+        self.charging = False
+
+        self.lat = home['lat'] + (0.05 if away else 0.0)
+        self.lon = home['lon'] + (0.05 if away else 0.0)
+
+    def charging_power(self):
+        return self.amps * 240 if self.charging else 0
+
+    def charging_state(self):
+        if not self.plugged:
+            return 'Disconnected'
+        if self.charging:
+            return 'Charging'
+        if self.battery_level >= self.charge_limit_soc:
+            return 'Complete'
+
+        return 'Stopped'
+
+    def update(self, now, sleep_after):
+        dt = now - self.last_update
+
+        if self.charging:
+            kwh = self.charging_power() * dt / 3.6e6
+            self.charge_energy_added += kwh
+            self.battery_level = min(self.battery_level + 100 * kwh / self.capacity, 100.0)
+            self.last_activity = now
+
+            if self.battery_level >= self.charge_limit_soc:
+                self.charging = False
+
+        if self.awake_at and now >= self.awake_at:
+            self.state = 'online'
+            self.awake_at = None
+            self.last_activity = now
+
+        if self.state == 'online' and (now - self.last_activity) > sleep_after:
+            self.state = 'asleep'
+
+        self.last_update = now
+
+    def touch(self, now):
+        self.last_activity = now
+
+    def wake(self, now, wake_delay):
+        if self.state != 'online' and not self.awake_at:
+            self.awake_at = now + wake_delay
+
+    def listing(self):
+        return { 'id'           : self.id,
+                 'vehicle_id'   : self.id,
+                 'vin'          : f"SIM{self.id:014d}",
+                 'display_name' : self.display_name,
+                 'state'        : self.state }
+
+    def vehicle_data(self):
+        vdata = self.listing()
+
+        vdata['charge_state'] = { 'battery_level'             : int(self.battery_level),
+                                  'charge_limit_soc'          : self.charge_limit_soc,
+                                  'charging_state'            : self.charging_state(),
+                                  'charge_current_request'    : self.amps,
+                                  'charge_current_request_max': self.amps_max,
+                                  'charger_actual_current'    : self.amps if self.charging else 0,
+                                  'charger_voltage'           : 240 if self.charging else 0,
+                                  'charger_power'             : round(self.charging_power() / 1000, 1),
+                                  'charge_energy_added'       : round(self.charge_energy_added, 2) }
+
+        vdata['drive_state'] = { 'latitude'    : self.lat,
+                                 'longitude'   : self.lon,
+                                 'shift_state' : None }
+
+        return vdata
+
+class SimSite():
+    def __init__(self, system_id, street, lat, lon, peak, now, history_days=15):
+        self.system_id = system_id
+        self.street = street
+        self.lat = lat
+        self.lon = lon
+        self.peak = peak
+        self.vehicles = []
+
+        self.battery_capacity = 13500.0
+        self.battery_rate = 5000.0
+        self.soc = 60.0
+
+        self.intervals = {}
+        self.ev_energy = {}
+        self.stream_until = 0
+        self.generated_until = int(now // INTERVAL * INTERVAL) - history_days * 86400
+        self.last_accumulate = now
+
+    def home(self):
+        return { 'lat' : self.lat, 'lon' : self.lon }
+
+    def accumulate(self, now):
+        power = sum(v.charging_power() for v in self.vehicles)
+
+        t = self.last_accumulate
+        while t < now:
+            boundary = (t // INTERVAL + 1) * INTERVAL
+            segment_end = min(boundary, now)
+            self.ev_energy[int(boundary)] = self.ev_energy.get(int(boundary), 0) + power * (segment_end - t) / 3600
+            t = segment_end
+
+        self.last_accumulate = now
+
+    def production(self, end_at):
+        # Local solar time, so production follows the sun wherever the site is placed.
+        hour = ((end_at - INTERVAL / 2) / 3600 + self.lon / 15) % 24
+        sun = max(0.0, math.sin(math.pi * (hour - 6) / 13))
+        clouds = 1 - 0.6 * noise(self.system_id, 'clouds', end_at // 3600) * noise(self.system_id, 'day', end_at // 86400)
+
+        return self.peak * sun * clouds
+
+    def consumption(self, end_at):
+        return 500 + 700 * noise(self.system_id, 'load', end_at)
+
+    def live(self, now):
+        pv = self.production(now + INTERVAL / 2)
+        load = self.consumption((int(now) // INTERVAL + 1) * INTERVAL) + sum(v.charging_power() for v in self.vehicles)
+
+        # Positive storage power is the battery discharging, as the Envoy reports it.
+        if pv > load:
+            storage = -min(pv - load, self.battery_rate) if self.soc < 100 else 0.0
+        else:
+            storage = min(load - pv, self.battery_rate) if self.soc > 10 else 0.0
+
+        return { 'pv' : pv, 'load' : load, 'storage' : storage, 'grid' : load - pv - storage }
+
+    def generate(self, until):
+        for end_at in range(self.generated_until + INTERVAL, int(until) + 1, INTERVAL):
+            produced = self.production(end_at) / 4
+            consumed = self.consumption(end_at) / 4 + self.ev_energy.pop(end_at, 0)
+
+            surplus = produced - consumed
+            charge = 0.0
+            discharge = 0.0
+            if surplus > 0:
+                charge = min(surplus, self.battery_rate / 4, self.battery_capacity * (100 - self.soc) / 100)
+            else:
+                discharge = min(-surplus, self.battery_rate / 4, self.battery_capacity * (self.soc - 10) / 100)
+            self.soc = max(min(self.soc + 100 * (charge - discharge) / self.battery_capacity, 100.0), 0.0)
+
+            self.intervals[end_at] = { 'end_at'    : end_at,
+                                       'wh_del'    : int(produced),
+                                       'enwh'      : int(consumed),
+                                       'charge'    : int(charge),
+                                       'discharge' : int(discharge),
+                                       'soc'       : int(self.soc) }
+            self.generated_until = end_at
+
+    def telemetry(self, meter, start_at, until):
+        self.generate(until)
+
+        end = min(int(start_at) + 7 * 86400, int(until))
+        first = (int(start_at) // INTERVAL + 1) * INTERVAL
+        rows = [ self.intervals[t] for t in range(first, end + 1, INTERVAL) if t in self.intervals ]
+
+        data = { 'system_id'   : self.system_id,
+                 'granularity' : 'week',
+                 'start_at'    : int(start_at),
+                 'end_at'      : end,
+                 'items'       : 'intervals' }
+
+        if meter == 'production_meter':
+            data['intervals'] = [ { 'end_at' : r['end_at'], 'devices_reporting' : 1, 'wh_del' : r['wh_del'] }
+                                  for r in rows ]
+        elif meter == 'consumption_meter':
+            data['intervals'] = [ { 'end_at' : r['end_at'], 'devices_reporting' : 1, 'enwh' : r['enwh'] }
+                                  for r in rows ]
+        else:
+            data['intervals'] = [ { 'end_at'    : r['end_at'],
+                                    'charge'    : { 'enwh' : r['charge'], 'devices_reporting' : 1 },
+                                    'discharge' : { 'enwh' : r['discharge'], 'devices_reporting' : 1 },
+                                    'soc'       : { 'percent' : r['soc'], 'devices_reporting' : 1 } }
+                                  for r in rows ]
+            data['last_reported_aggregate_soc'] = f"{int(self.soc)}%"
+
+        return data
+
+class SimWorld():
+    def __init__(self, sites=1, vehicles=2, asleep=0.5, away=0.2, peak=7000, publish_latency=300,
+                 sleep_after=900, wake_delay=10, seed=0, home_lat=HOME_LAT, home_lon=HOME_LON):
+        self.lock = threading.RLock()
+        self.publish_latency = publish_latency
+        self.sleep_after = sleep_after
+        self.wake_delay = wake_delay
+
+        rng = random.Random(seed)
+        now = time.time()
+
+        self.sites = {}
+        self.vehicles = {}
+        for n in range(1, sites + 1):
+            site = SimSite(n, f"{n} Solar Way", home_lat + 0.01 * n, home_lon, peak, now)
+            self.sites[n] = site
+
+            for k in range(1, vehicles + 1):
+                vehicle_id = n * 1000 + k
+                vehicle = SimVehicle(vehicle_id, n, f"Sim {n}-{k}", site.home(), rng, now,
+                                     rng.random() < asleep, rng.random() < away)
+                site.vehicles.append(vehicle)
+                self.vehicles[vehicle_id] = vehicle
+
+    def tick(self):
+        now = time.time()
+
+        for site in self.sites.values():
+            site.accumulate(now)
+
+        for vehicle in self.vehicles.values():
+            vehicle.update(now, self.sleep_after)
+
+        return now
+
+    def published_until(self, now):
+        return int((now - self.publish_latency) // INTERVAL * INTERVAL)
+
+    def site_for_street(self, street):
+        for site in self.sites.values():
+            if site.street == street:
+                return site
+
+        return self.sites[1]
+
+    def street_at(self, lat, lon):
+        for site in self.sites.values():
+            if distance(site.lat, site.lon, lat, lon) <= 60:
+                return site.street
+
+        return f"{int(abs(lat) * 1000) % 1000} Elsewhere Rd"
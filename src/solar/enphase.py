@@ -9,38 +9,54 @@
 # You should have received a copy of the GNU General Public License along with Helios.
 # If not, see <https://www.gnu.org/licenses/>.
 
-import os
 import sys
 import time
 import requests
 import urllib
 import base64
-import json
 import logging
 import pprint
 
-from datetime import datetime
 from dateutil import tz as timezone
 
+from net import transport, tokens, retry
+from solar.store import TelemetryStore
+from solar.series import TelemetryUnavailable
+from solar.generation import GenerationProfile
+from solar.forecast import IntervalForecaster
+from solar.quota import QuotaBudget, PRIORITY_CONTROL, PRIORITY_BACKGROUND
+
 l = logging.getLogger('helios')
 
 class EnphaseInterface():
-    def __init__(self, system_id, api_key, client_id, client_secret, auth_code, token_file):
+    def __init__(self, system_id, api_key, client_id, client_secret, auth_code, token_file,
+                 store_file='.enphase_telemetry.db', generation_file='.generation_profile.json',
+                 generation_days=14, quota=None, base_url='https://api.enphaseenergy.com', forecast=None,
+                 deadline=150):
         self.__system_id = system_id
         self.__api_key = api_key
         self.__client_id = client_id
         self.__client_secret = client_secret
         self.__auth_code = auth_code
-        self.__token_file = token_file
-
-        self.__api_url = 'https://api.enphaseenergy.com/api/v4'
-        self.__redirect_url = 'https://api.enphaseenergy.com/oauth/redirect_uri'
-        self.__auth_url = 'https://api.enphaseenergy.com/oauth/authorize'
-        self.__refresh_url = 'https://api.enphaseenergy.com/oauth/token'
-
-        self.__auth_tokens = None
-        self.__access_headers = None
-        self.__last_refresh = None
+        self.__interval_length = 900
+        self.__settle_time = 86400
+        self.__store = TelemetryStore(store_file, self.__interval_length)
+        self.__generation = GenerationProfile(self.__store, generation_file, generation_days)
+        self.__generation_days = generation_days
+
+        forecast = forecast or {}
+        self.__forecaster = IntervalForecaster(self.__store, interval=self.__interval_length, **forecast)
+        self.__forecast_days = forecast.get('days', 7)
+
+        self.__quota = QuotaBudget(store=self.__store, **(quota or {}))
+        self.__coalesce_window = 60
+        self.__recent_responses = {}
+        self.__retry = retry.RetryPolicy('enphase', deadline)
+
+        self.__api_url = f"{base_url}/api/v4"
+        self.__redirect_url = f"{base_url}/oauth/redirect_uri"
+        self.__auth_url = f"{base_url}/oauth/authorize"
+        self.__refresh_url = f"{base_url}/oauth/token"
 
         auth_basic = base64.b64encode(f"{self.__client_id}:{self.__client_secret}".encode('ascii')).decode('ascii')
         self.__refresh_token_headers = { 'Authorization' : f'Basic {auth_basic}' }
@@ -49,6 +65,8 @@ class EnphaseInterface():
                                      'redirect_uri' : self.__redirect_url,
                                      'code'         : self.__auth_code }
 
+        self.__tokens = tokens.manager('enphase', token_file, self.__grant)
+
     def print_auth_url(self):
         print("")
         print("Use this url to authorize access to your Enphase system")
@@ -57,167 +75,198 @@ class EnphaseInterface():
         print(f"{self.__auth_url}?response_type=code&client_id={self.__client_id}&redirect_uri={self.__redirect_url}")
         print("")
 
-    def refresh_tokens(self):
-        if self.__last_refresh:
-            if (time.time() - self.__last_refresh) < 14400:
-                return
-
-        self.__auth_tokens = {}
-        if os.path.exists(self.__token_file):
-            l.debug(f"Found existing tokens in '{self.__token_file}', refreshing ...")
-            with open(self.__token_file, 'r') as token_store:
-                self.__auth_tokens = json.load(token_store)
-
+    def __grant(self, auth_tokens):
+        if auth_tokens:
             refresh_data = { 'grant_type'    : 'refresh_token',
-                             'refresh_token' : self.__auth_tokens['refresh_token'] }
-
-            for i in range(0,11):
-                r = requests.post(self.__refresh_url, data=refresh_data, headers=self.__refresh_token_headers)
-                if r.status_code == 200:
-                    break
-                time.sleep(3)
-
-            if r.status_code == 200:
-                self.__auth_tokens = r.json()
-                with open(self.__token_file, 'w') as token_store:
-                    json.dump(self.__auth_tokens, token_store)
-            else:
-                l.error(f"Failed to refresh Enphase auth tokens.  Exiting. {r}")
-                exit(1)
+                             'refresh_token' : auth_tokens['refresh_token'] }
         else:
             l.info(f"No tokens found, fetching ...")
-            r = requests.post(self.__refresh_url, data=self.__fetch_tokens_data,
-                headers=self.__refresh_token_headers)
-            if r.status_code == 200:
-                self.__auth_tokens = r.json()
-                with open(self.__token_file, 'w') as token_store:
-                    json.dump(self.__auth_tokens, token_store)
-            else:
-                l.error(f"Failed to get Enphase autho tokens.  Exiting. {r}")
-                exit(1)
+            refresh_data = self.__fetch_tokens_data
 
-        self.__access_headers = { 'Authorization' : f"Bearer {self.__auth_tokens['access_token']}" }
+        return transport.shared().post(self.__refresh_url, data=refresh_data, headers=self.__refresh_token_headers)
 
-        self.__last_refresh = time.time()
+    def authorize(self):
+        self.__tokens.acquire()
 
-    def __get_energy_data(self, base_url, params, method):
+    def close(self):
+        tokens.release(self.__tokens)
+        self.__store.close()
+
+    def get_quota(self):
+        return self.__quota.remaining()
+
+    def __get_energy_data(self, base_url, params, method, priority=PRIORITY_CONTROL, coalesce=True):
 
         url = f"{base_url}/{method}{params}"
         api_path = urllib.parse.urlparse(url).path
 
+        if coalesce and url in self.__recent_responses:
+            t, data = self.__recent_responses[url]
+            if (time.time() - t) <= self.__coalesce_window:
+                l.debug(f"Enphase API GET {api_path} => coalesced with response from {int(time.time() - t)}s ago")
+                return data
+
         r = None
-        for i in range(0,31):
-            r = requests.get(url, headers=self.__access_headers)
-            if r.status_code == 200:
-                break
-            elif r.status_code == 422:
+        error = None
+        attempts = self.__retry.attempts(url, max_attempts=31)
+        try:
+            for i in attempts:
+                if not self.__quota.acquire(priority):
+                    break
+
+                headers = self.__tokens.headers()
+                try:
+                    r = transport.shared().get(url, headers=headers)
+                except requests.exceptions.RequestException as err:
+                    l.warn(f"Enphase API GET {api_path} => {err}")
+                    error = err
+                    attempts.retry(type(err).__name__)
+                    continue
+
+                if r.status_code == 200:
+                    attempts.success()
+                    break
+
                 l.warn(f"Enphase API GET {api_path} => {r}")
-                l.warn("Request understood, but could not be processed sleep for 5 minutes.")
-                time.sleep(300)
+
+                if r.status_code == 401:
+                    self.__tokens.expire(headers)
+                    attempts.retry(r.status_code, 5, fault=False)
+                elif r.status_code == 429:
+                    self.__quota.throttle()
+                    attempts.retry(r.status_code, 0, fault=False)
+                elif r.status_code == 422:
+                    attempts.retry(r.status_code, fault=False)
+                else:
+                    attempts.retry(r.status_code, fault=r.status_code >= 500)
+        except retry.CircuitOpen as err:
+            l.warn(f"Enphase API GET {api_path} => {err} Using stored data.")
+            return None
+
+        # An outage is seen as missing data, the cycle is skipped rather than
+        # the site failed.
+        if r is None:
+            if error:
+                l.warn(f"Enphase API GET {api_path} gave up => {error} Using stored data.")
             else:
-                l.warn(f"Enphase API GET {api_path} => {r}")
-                time.sleep(10)
+                l.warn(f"Enphase API GET {api_path} deferred by quota, using stored data.")
+            return None
 
-        if r.status_code == 200:
-            l.debug(f"Enphase API GET {api_path} => {r}")
-        else:
+        if r.status_code != 200:
             l.error(f"Enphase API GET {api_path} => {r}")
+            return None
+
+        l.debug(f"Enphase API GET {api_path} => {r}")
 
-        return r.json()
+        data = r.json()
 
-    def __get_meter_data(self, method, last_n_seconds):
+        now = time.time()
+        self.__recent_responses = { u : v for u, v in self.__recent_responses.items()
+                                    if (now - v[0]) <= self.__coalesce_window }
+        self.__recent_responses[url] = (now, data)
+
+        return data
+
+    def __get_meter_data(self, method, start_at, priority, coalesce=True):
         granularity = 'week'
-        start_at = int(time.time()) - last_n_seconds
 
         base_url = f"{self.__api_url}/systems/{self.__system_id}/telemetry"
         params = f"?granularity={granularity}&start_at={start_at}&key={self.__api_key}"
 
-        return self.__get_energy_data(base_url, params, method)
+        return self.__get_energy_data(base_url, params, method, priority, coalesce)
 
-    def get_generation_range(self, tz):
-        tz = timezone.gettz(tz)
-        energy_data = self.get_pro_meters(1209600)
+    def __fill(self, method, start_at, end_at, now, priority, coalesce):
+        # A week of intervals is returned per request.
+        while (end_at - start_at) >= self.__interval_length:
+            data = self.__get_meter_data(method, start_at, priority, coalesce)
+            if data is None:
+                return False
 
-        time_one = None
-        time_two = None
+            intervals = data.get('intervals', [])
 
-        gen = []
+            self.__store.append(method, intervals)
 
-        gen_d = {}
-        for item in energy_data:
-            dt = datetime.fromtimestamp(int(item['end_time']), tz=tz)
-            if not dt.hour in gen_d:
-                gen_d[dt.hour] = []
-            gen_d[dt.hour].append(item['pwr_produced'])
+            if 'last_reported_aggregate_soc' in data:
+                self.__store.set_meta('last_reported_aggregate_soc', data['last_reported_aggregate_soc'])
 
-        for h in range(0,23):
-            gen.append(sum(gen_d[h]) / len(gen_d[h]))
+            # What was returned is known, and so is a week old enough that nothing
+            # more will be published for it.
+            page_end = min(start_at + 7 * 86400, now)
+            covered = intervals[-1]['end_at'] if intervals else start_at
+            if page_end <= now - self.__settle_time:
+                covered = max(covered, page_end)
 
-        for h in range(0,23):
-            if not time_one and gen[h] >= 1200:
-                time_one = h
-                l.debug(f"Found time one: {time_one}")
-            if time_one and not time_two and gen[h] < 1200:
-                time_two = h
-                l.debug(f"Found time two: {time_two}")
+            self.__store.cover(method, start_at, covered)
 
-        gen_range = []
-        for i in range(time_one, time_two+1):
-            gen_range.append(i)
+            if page_end >= end_at or covered <= start_at:
+                break
 
-        return gen_range
+            start_at = covered
 
-    def get_battery_charge(self):
-        bat = self.__get_meter_data('battery', 3600)
+        return True
 
-        battery_data = { 'level' : None, 'intervals' : [] }
+    def __sync_meter_data(self, method, last_n_seconds, priority=PRIORITY_CONTROL, coalesce=True):
+        now = int(time.time())
 
-        max_len = len(bat['intervals'])
-        for i in range(0, max_len):
-            interval = {}
-            interval['level'] = bat['intervals'][i]['soc']['percent']
-            interval['pwr_charged'] = bat['intervals'][i]['charge']['enwh'] * 4
-            battery_data['intervals'].append(interval)
+        # Newest first, so the latest intervals are never held up behind a
+        # backfill, a gap left by downtime or a failed request is filled later.
+        for start_at, end_at in reversed(self.__store.missing(method, now - last_n_seconds, now)):
+            if not self.__fill(method, start_at, end_at, now, priority, coalesce):
+                break
 
-        battery_data['level'] = int(bat['last_reported_aggregate_soc'][:-1])
+    def get_latest_interval_end(self, probe=False):
+        self.__sync_meter_data('production_meter', 3600, coalesce=not probe)
 
-        return battery_data
+        return self.__store.last_end_at('production_meter')
 
-    def get_pro_meters(self, last_n_seconds=3600):
-        energy_data = []
+    def get_generation_profile(self, tz):
+        tz = timezone.gettz(tz)
 
-        pro = self.__get_meter_data('production_meter', last_n_seconds)
+        self.__sync_meter_data('production_meter', (self.__generation_days + 1) * 86400,
+                               PRIORITY_BACKGROUND)
 
-        max_len = len(pro['intervals'])
-        for i in range(0, max_len):
-            interval = { 'end_time'      : pro['intervals'][i]['end_at'],
-                         'dt'            : time.ctime(pro['intervals'][i]['end_at']),
-                         'eng_produced'  : pro['intervals'][i]['wh_del'],
-                         'pwr_produced'  : pro['intervals'][i]['wh_del'] * 4 }
+        return self.__generation.get_profile(tz)
 
-            energy_data.append(interval)
+    def get_generation_range(self, tz):
+        profile = self.get_generation_profile(tz)
 
-        return energy_data
+        if not profile:
+            return []
 
-    def get_meters(self, last_n_seconds=3600):
-        energy_data = []
+        return profile['range']
+
+    def get_forecast(self):
+        # get_meters has already brought the latest intervals in, so the window
+        # here is only missing the older history for the seasonal baseline,
+        # which is backfilled in the background until the store holds it all.
+        for meter in ( 'production_meter', 'consumption_meter' ):
+            self.__sync_meter_data(meter, (self.__forecast_days + 1) * 86400, PRIORITY_BACKGROUND)
+
+        return self.__forecaster.forecast()
+
+    def get_battery_charge(self):
+        self.__sync_meter_data('battery', 3600)
 
-        pro = self.__get_meter_data('production_meter', last_n_seconds)
-        con = self.__get_meter_data('consumption_meter', last_n_seconds)
+        intervals = self.__store.series('battery', int(time.time()) - 3600, interval=self.__interval_length)
 
-        max_len = len(pro['intervals'])
-        for i in range(0, max_len):
-            exported = pro['intervals'][i]['wh_del'] - con['intervals'][i]['enwh']
+        soc = self.__store.get_meta('last_reported_aggregate_soc')
+        if not soc or len(intervals) == 0:
+            raise TelemetryUnavailable("No Enphase battery data for the last hour.")
 
-            interval = { 'end_time'      : pro['intervals'][i]['end_at'],
-                         'dt'            : time.ctime(pro['intervals'][i]['end_at']),
-                         'eng_produced'  : pro['intervals'][i]['wh_del'],
-                         'eng_consumed'  : con['intervals'][i]['enwh'],
-                         'eng_exported'  : exported,
-                         'pwr_produced'  : pro['intervals'][i]['wh_del'] * 4,
-                         'pwr_consumed'  : con['intervals'][i]['enwh'] * 4,
-                         'pwr_exported'  : exported * 4 }
+        return { 'level' : int(soc.rstrip('%')), 'intervals' : intervals }
+
+    def get_pro_meters(self, last_n_seconds=3600):
+        self.__sync_meter_data('production_meter', last_n_seconds)
+
+        return self.__store.series('production_meter', int(time.time()) - last_n_seconds,
+                                   interval=self.__interval_length)
+
+    def get_meters(self, last_n_seconds=3600):
+        self.__sync_meter_data('production_meter', last_n_seconds)
+        self.__sync_meter_data('consumption_meter', last_n_seconds)
 
-            energy_data.append(interval)
+        meters = self.__store.meter_series(int(time.time()) - last_n_seconds, interval=self.__interval_length)
+        if len(meters) == 0:
+            raise TelemetryUnavailable(f"No Enphase meter data for the last {last_n_seconds} seconds.")
 
-        return energy_data
+        return meters
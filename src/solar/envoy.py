@@ -0,0 +1,224 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import json
+import requests
+import urllib
+import logging
+import threading
+import numpy as np
+
+from collections import deque
+
+from net import transport, retry
+from solar.series import IntervalSeries, TelemetryUnavailable
+
+l = logging.getLogger('helios')
+
+class EnvoyInterface():
+    def __init__(self, url, token=None, verify=False, window=60, history=3600, min_sample_age=1, deadline=10,
+                 sample_interval=5):
+        self.__url = url.rstrip('/')
+        self.__headers = { 'Authorization' : f"Bearer {token}" } if token else {}
+        self.__verify = verify
+        self.__window = window
+        self.__history = history
+        self.__min_sample_age = min_sample_age
+        self.__sample_interval = sample_interval
+
+        self.__lock = threading.Lock()
+        self.__samples = deque()
+        self.__retry = retry.RetryPolicy('envoy', deadline)
+
+        # Readings are taken all through each window so that it holds their
+        # mean, not just whatever was read when the decision was made.
+        self.__stop = threading.Event()
+        self.__thread = None
+        if sample_interval:
+            self.__thread = threading.Thread(target=self.__run, name='envoy-sampler', daemon=True)
+            self.__thread.start()
+
+    def __run(self):
+        while not self.__stop.wait(self.__sample_interval):
+            try:
+                self.__sample()
+            except Exception as err:
+                l.debug(f"Envoy reading failed => {err}")
+
+    def close(self):
+        self.__stop.set()
+
+    def get_interval(self):
+        return self.__window
+
+    def __request(self, method, path, body=None, max_attempts=4):
+        url = f"{self.__url}{path}"
+        api_path = urllib.parse.urlparse(url).path
+
+        r = None
+        error = None
+        attempts = self.__retry.attempts(url, max_attempts=max_attempts)
+        for i in attempts:
+            try:
+                if method == 'GET':
+                    r = transport.shared().get(url, headers=self.__headers, verify=self.__verify)
+                else:
+                    r = transport.shared().post(url, data=json.dumps(body), headers=self.__headers,
+                                                verify=self.__verify)
+            except requests.exceptions.RequestException as err:
+                l.warn(f"Envoy {method} {api_path} => {err}")
+                error = err
+                attempts.retry(type(err).__name__)
+                continue
+
+            if r.status_code == 200:
+                attempts.success()
+                break
+
+            l.warn(f"Envoy {method} {api_path} => {r}")
+            attempts.retry(r.status_code, fault=r.status_code >= 500)
+
+        if r is None:
+            raise error
+
+        if r.status_code != 200:
+            l.error(f"Envoy {method} {api_path} => {r}")
+            return None
+
+        l.debug(f"Envoy {method} {api_path} => {r}")
+
+        return r.json()
+
+    def __sample(self):
+        now = time.time()
+
+        # One reading serves every call made within a control cycle.
+        with self.__lock:
+            if self.__samples and (now - self.__samples[-1]['t']) < self.__min_sample_age:
+                return
+
+        status = self.__request('GET', '/ivp/livedata/status')
+
+        # Live data is only streamed for a few minutes after it is asked for.
+        if status and status.get('connection', {}).get('sc_stream') != 'enabled':
+            l.debug("Enabling the Envoy live data stream.")
+            self.__request('POST', '/ivp/livedata/stream', { 'enable' : 1 })
+            status = self.__request('GET', '/ivp/livedata/status')
+
+        if not status:
+            return
+
+        meters = status['meters']
+        sample = { 't'       : now,
+                   'pv'      : meters['pv']['agg_p_mw'] / 1000,
+                   'load'    : meters['load']['agg_p_mw'] / 1000,
+                   'storage' : meters['storage']['agg_p_mw'] / 1000,
+                   'soc'     : meters.get('enc_agg_soc', meters.get('soc')) }
+
+        with self.__lock:
+            if self.__samples and self.__samples[-1]['t'] > now:
+                return
+
+            self.__samples.append(sample)
+
+            while self.__samples and (now - self.__samples[0]['t']) > self.__history:
+                self.__samples.popleft()
+
+    def __latest(self):
+        # A failed reading leaves the ones already taken, which are only used
+        # while they are recent.
+        try:
+            self.__sample()
+        except requests.exceptions.RequestException as err:
+            l.warning(f"Envoy reading failed => {err}")
+
+        with self.__lock:
+            samples = list(self.__samples)
+
+        if not samples or (time.time() - samples[-1]['t']) > 2 * self.__window:
+            raise TelemetryUnavailable("No recent reading from the Envoy.")
+
+        return samples
+
+    def __windows(self, last_n_seconds):
+        samples = self.__latest()
+
+        since = time.time() - last_n_seconds
+
+        windows = {}
+        for sample in samples:
+            if sample['t'] > since:
+                end_time = (int(sample['t']) // self.__window + 1) * self.__window
+                windows.setdefault(end_time, []).append(sample)
+
+        # Readings are averaged over each window, the last one is still filling.
+        for end_time in sorted(windows):
+            samples = windows[end_time]
+            mean = { k : sum(s[k] for s in samples) / len(samples) for k in ( 'pv', 'load', 'storage' ) }
+
+            # Not every reading carries the battery's charge level.
+            soc = [ s['soc'] for s in samples if s['soc'] is not None ]
+            mean['soc'] = sum(soc) / len(soc) if soc else np.nan
+
+            yield end_time, mean
+
+    def get_latest_interval_end(self, probe=False):
+        try:
+            samples = self.__latest()
+        except TelemetryUnavailable:
+            return None
+
+        return int(samples[-1]['t']) // self.__window * self.__window
+
+    def get_quota(self):
+        # Readings from the Envoy are not metered.
+        return None
+
+    def get_forecast(self):
+        # Readings seconds apart already track production, there is nothing to
+        # gain from a forecast built for quarter hour intervals.
+        return None
+
+    def __series(self, last_n_seconds, columns):
+        end_times = []
+        means = { k : [] for k in ( 'pv', 'load', 'storage', 'soc' ) }
+
+        for end_time, mean in self.__windows(last_n_seconds):
+            end_times.append(end_time)
+            for k in means:
+                means[k].append(mean[k])
+
+        pv = np.array(means['pv'])
+        load = np.array(means['load'])
+
+        # Positive storage power is the battery discharging.
+        values = { 'produced' : pv,
+                   'consumed' : load,
+                   'exported' : pv - load,
+                   'charged'  : np.maximum(-np.array(means['storage']), 0),
+                   'soc'      : np.floor(means['soc']) }
+
+        return IntervalSeries(self.__window, end_time=end_times, **{ k : values[k] for k in columns })
+
+    def get_battery_charge(self):
+        intervals = self.__series(3600, ( 'charged', 'soc' ))
+
+        if len(intervals) == 0 or np.isnan(intervals['soc'][-1]):
+            raise TelemetryUnavailable("No battery charge level from the Envoy.")
+
+        return { 'level' : int(intervals['soc'][-1]), 'intervals' : intervals }
+
+    def get_pro_meters(self, last_n_seconds=3600):
+        return self.__series(last_n_seconds, ( 'produced', ))
+
+    def get_meters(self, last_n_seconds=3600):
+        return self.__series(last_n_seconds, ( 'produced', 'consumed', 'exported' ))
@@ -0,0 +1,117 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import numpy as np
+
+l = logging.getLogger('helios')
+
+class IntervalForecaster():
+    def __init__(self, store, days=7, history=8, alpha=0.5, seasonal_weight=0.5, interval=900,
+                 min_seasonal=50):
+        self.__store = store
+        self.__days = days
+        self.__history = history
+        self.__alpha = alpha
+        self.__seasonal_weight = seasonal_weight
+        self.__interval = interval
+        self.__min_seasonal = min_seasonal
+
+    def __series(self, meter, column, since, until):
+        series = self.__store.series(meter, since, until, self.__interval)
+
+        return series['end_time'], series.energy(column)
+
+    def __seasonal(self, end_times, values, targets):
+        # Median of the same interval over the prior days, one row per target.
+        seasonal = np.full(len(targets), np.nan)
+        if len(end_times) == 0:
+            return seasonal
+
+        lags = targets[:, None] - 86400 * np.arange(1, self.__days + 1)[None, :]
+
+        idx = np.minimum(np.searchsorted(end_times, lags), len(end_times) - 1)
+        found = end_times[idx] == lags
+        samples = np.where(found, values[idx], np.nan)
+
+        has = found.any(axis=1)
+        seasonal[has] = np.nanmedian(samples[has], axis=1)
+
+        return seasonal
+
+    def __smooth(self, values):
+        # Simple exponential smoothing, weights decay from the newest value back.
+        weights = (1 - self.__alpha) ** np.arange(len(values))[::-1]
+
+        return float(np.sum(weights * values) / np.sum(weights))
+
+    def __recent(self, end_times, values, last_end_at):
+        mask = end_times > last_end_at - self.__history * self.__interval
+
+        return end_times[mask], values[mask]
+
+    def __forecast_production(self, end_times, values, last_end_at, target):
+        recent_times, recent = self.__recent(end_times, values, last_end_at)
+        if len(recent) == 0:
+            return None
+
+        seasonal_recent = self.__seasonal(end_times, values, recent_times)
+        seasonal_next = self.__seasonal(end_times, values, np.array([ target ]))[0]
+
+        # Clouds persist, so scale the usual production for the next interval by
+        # how the recent intervals compared to their usual production.
+        usable = seasonal_recent >= self.__min_seasonal
+        if np.isnan(seasonal_next) or not usable.any():
+            l.debug("No production history for the next interval, assuming persistence.")
+            return float(recent[-1])
+
+        ratio = np.clip(recent[usable] / seasonal_recent[usable], 0, 1.5)
+        ratio = self.__smooth(ratio)
+
+        l.debug(f"Production forecast: usual {seasonal_next:.0f} Wh x recent ratio {ratio:.2f}")
+
+        return float(seasonal_next * ratio)
+
+    def __forecast_consumption(self, end_times, values, last_end_at, target):
+        recent_times, recent = self.__recent(end_times, values, last_end_at)
+        if len(recent) == 0:
+            return None
+
+        level = self.__smooth(recent)
+        seasonal_next = self.__seasonal(end_times, values, np.array([ target ]))[0]
+
+        if np.isnan(seasonal_next):
+            return level
+
+        return float(self.__seasonal_weight * seasonal_next + (1 - self.__seasonal_weight) * level)
+
+    def forecast(self):
+        last_end_at = self.__store.last_end_at('production_meter')
+        if not last_end_at:
+            return None
+
+        target = last_end_at + self.__interval
+        since = target - self.__days * 86400 - self.__history * self.__interval
+
+        prod_times, produced = self.__series('production_meter', 'produced', since, last_end_at)
+        cons_times, consumed = self.__series('consumption_meter', 'consumed', since, last_end_at)
+
+        eng_produced = self.__forecast_production(prod_times, produced, last_end_at, target)
+        eng_consumed = self.__forecast_consumption(cons_times, consumed, last_end_at, target)
+
+        if eng_produced is None or eng_consumed is None:
+            return None
+
+        to_power = 3600 / self.__interval
+
+        return { 'end_time'     : target,
+                 'pwr_produced' : eng_produced * to_power,
+                 'pwr_consumed' : eng_consumed * to_power }
@@ -0,0 +1,158 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import json
+import logging
+import numpy as np
+
+from datetime import date, datetime, timedelta
+
+l = logging.getLogger('helios')
+
+def local_time(end_times, tz):
+    # UTC offsets only change on the hour, so one lookup per distinct UTC hour
+    # is enough to shift every timestamp into local time.
+    utc_hours, inverse = np.unique(end_times // 3600, return_inverse=True)
+    offsets = np.array([ datetime.fromtimestamp(int(h) * 3600, tz=tz).utcoffset().total_seconds()
+                         for h in utc_hours ], dtype=np.int64)
+
+    return end_times + offsets[inverse]
+
+class GenerationProfile():
+    def __init__(self, store, cache_file, window_days=14, threshold=1200, percentiles=(10, 50, 90)):
+        self.__store = store
+        self.__cache_file = cache_file
+        self.__window_days = window_days
+        self.__threshold = threshold
+        self.__percentiles = percentiles
+
+        self.__cache = { 'days' : {}, 'profiles' : {} }
+
+        self.__load()
+
+    def __load(self):
+        if self.__cache_file and os.path.exists(self.__cache_file):
+            try:
+                with open(self.__cache_file, 'r') as cache_store:
+                    self.__cache = json.load(cache_store)
+            except ValueError as err:
+                l.warning(f"Ignoring unreadable generation cache '{self.__cache_file}' => {err}")
+
+    def __save(self):
+        if not self.__cache_file:
+            return
+
+        tmp_file = f"{self.__cache_file}.tmp"
+        with open(tmp_file, 'w') as cache_store:
+            json.dump(self.__cache, cache_store)
+        os.replace(tmp_file, self.__cache_file)
+
+    def __day_start(self, day, tz):
+        return int(datetime(day.year, day.month, day.day, tzinfo=tz).timestamp())
+
+    def __load_days(self, days, tz):
+        since = self.__day_start(days[0], tz)
+        until = self.__day_start(days[-1] + timedelta(days=1), tz)
+
+        series = self.__store.series('production_meter', since - 1, until - 1)
+        end_times = series['end_time']
+        produced = series['produced']
+
+        local = local_time(end_times, tz)
+        day_numbers = local // 86400
+        hours = (local // 3600) % 24
+
+        for day in days:
+            # Only days the store has fetched in full are cached, one with a gap
+            # is loaded again once the gap has been filled.
+            if self.__store.missing('production_meter', self.__day_start(day, tz),
+                                    self.__day_start(day + timedelta(days=1), tz)):
+                continue
+
+            mask = day_numbers == (day - date(1970, 1, 1)).days
+            self.__cache['days'][day.isoformat()] = { 'hours'    : hours[mask].tolist(),
+                                                      'produced' : produced[mask].tolist() }
+
+    def __compute(self, day_keys):
+        hours = np.array([ h for d in day_keys for h in self.__cache['days'][d]['hours'] ], dtype=np.int64)
+        produced = np.array([ p for d in day_keys for p in self.__cache['days'][d]['produced'] ],
+                            dtype=np.float64)
+
+        counts = np.bincount(hours, minlength=24)
+        sums = np.bincount(hours, weights=produced, minlength=24)
+        mean = np.divide(sums, counts, out=np.zeros(24), where=counts > 0)
+
+        # Lay the samples out as one column per hour so every percentile is a
+        # single nanpercentile over the matrix, hours without samples read as 0.
+        order = np.argsort(hours, kind='stable')
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        rows = np.arange(len(hours)) - np.repeat(starts, counts)
+
+        matrix = np.full((max(int(counts.max()), 1), 24), np.nan)
+        matrix[rows, hours[order]] = produced[order]
+        matrix[0, counts == 0] = 0
+
+        profile = { 'mean' : mean.round(1).tolist(), 'samples' : counts.tolist() }
+        for p, values in zip(self.__percentiles, np.nanpercentile(matrix, self.__percentiles, axis=0)):
+            profile[f"p{p}"] = values.round(1).tolist()
+
+        profile['range'] = self.__find_range(mean)
+
+        return profile
+
+    def __find_range(self, mean):
+        above = mean >= self.__threshold
+        if not above.any():
+            return []
+
+        time_one = int(np.argmax(above))
+        l.debug(f"Found time one: {time_one}")
+
+        below = ~above[time_one:]
+        if below.any():
+            time_two = time_one + int(np.argmax(below))
+            l.debug(f"Found time two: {time_two}")
+        else:
+            time_two = 23
+
+        return list(range(time_one, time_two + 1))
+
+    def get_profile(self, tz, day=None):
+        if day is None:
+            day = datetime.fromtimestamp(time.time(), tz=tz).date()
+
+        if day.isoformat() in self.__cache['profiles']:
+            return self.__cache['profiles'][day.isoformat()]
+
+        window = [ day - timedelta(days=n) for n in range(self.__window_days, 0, -1) ]
+        window_keys = [ d.isoformat() for d in window ]
+
+        missing = [ d for d in window if d.isoformat() not in self.__cache['days'] ]
+        if missing:
+            l.debug(f"Adding {len(missing)} days to the generation profile window.")
+            self.__load_days(missing, tz)
+
+        self.__cache['days'] = { k : v for k, v in self.__cache['days'].items() if k in window_keys }
+
+        available = [ k for k in window_keys if k in self.__cache['days'] ]
+        if len(available) == 0:
+            return None
+
+        profile = self.__compute(available)
+
+        # Profiles built from a partial window are recomputed on the next call.
+        if len(available) == len(window_keys):
+            self.__cache['profiles'] = { day.isoformat() : profile }
+        self.__save()
+
+        return profile
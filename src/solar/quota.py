@@ -0,0 +1,116 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import calendar
+import threading
+import logging
+
+l = logging.getLogger('helios')
+
+PRIORITY_CONTROL = 0
+PRIORITY_BACKGROUND = 1
+
+class QuotaBudget():
+    def __init__(self, per_minute=10, per_month=1000, reserve=0.2, max_wait=60, store=None):
+        self.__per_minute = per_minute
+        self.__per_month = per_month
+        self.__reserve = int(per_month * reserve)
+        self.__max_wait = max_wait
+        self.__store = store
+
+        self.__lock = threading.Lock()
+        self.__tokens = float(per_minute)
+        self.__last_fill = time.time()
+
+        self.__month = None
+        self.__month_used = 0
+        self.__load()
+
+    def __month_key(self, t):
+        return time.strftime('%Y-%m', time.gmtime(t))
+
+    def __load(self):
+        self.__month = self.__month_key(time.time())
+
+        if self.__store and self.__store.get_meta('quota_month') == self.__month:
+            self.__month_used = int(self.__store.get_meta('quota_month_used', 0))
+
+    def __save(self):
+        if self.__store:
+            self.__store.set_meta('quota_month', self.__month)
+            self.__store.set_meta('quota_month_used', self.__month_used)
+
+    def __refill(self, now):
+        elapsed = now - self.__last_fill
+        self.__tokens = min(float(self.__per_minute), self.__tokens + elapsed * self.__per_minute / 60)
+        self.__last_fill = now
+
+        month = self.__month_key(now)
+        if month != self.__month:
+            self.__month = month
+            self.__month_used = 0
+
+    def __month_allows(self, priority):
+        remaining = self.__per_month - self.__month_used
+
+        if priority == PRIORITY_BACKGROUND:
+            return remaining > self.__reserve
+
+        return remaining > 0
+
+    def acquire(self, priority=PRIORITY_CONTROL):
+        deadline = time.time() + self.__max_wait
+
+        while True:
+            with self.__lock:
+                now = time.time()
+                self.__refill(now)
+
+                if not self.__month_allows(priority):
+                    l.warning(f"Enphase monthly quota exhausted for priority {priority} requests.")
+                    return False
+
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    self.__month_used += 1
+                    self.__save()
+                    return True
+
+                wait = (1 - self.__tokens) * 60 / self.__per_minute
+
+            # Background requests are deferred rather than queued behind control data.
+            if priority == PRIORITY_BACKGROUND or now + wait > deadline:
+                l.debug(f"Enphase request deferred, per minute quota exhausted.")
+                return False
+
+            time.sleep(wait)
+
+    def throttle(self):
+        with self.__lock:
+            self.__tokens = 0
+            self.__last_fill = time.time()
+
+    def remaining(self):
+        with self.__lock:
+            now = time.time()
+            self.__refill(now)
+
+            t = time.gmtime(now)
+            next_month = time.struct_time((t.tm_year + t.tm_mon // 12, t.tm_mon % 12 + 1, 1,
+                                           0, 0, 0, 0, 0, 0))
+            hours_left = max((calendar.timegm(next_month) - now) / 3600, 1)
+
+            month_remaining = self.__per_month - self.__month_used
+
+            return { 'minute'   : int(self.__tokens),
+                     'month'    : month_remaining,
+                     'per_hour' : month_remaining / hours_left }
@@ -0,0 +1,67 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import numpy as np
+
+COLUMNS = ( 'end_time', 'produced', 'consumed', 'exported', 'charged', 'soc' )
+
+class TelemetryUnavailable(Exception):
+    pass
+
+class IntervalSeries():
+    # Power columns are the mean watts over each interval, soc is a percentage.
+    def __init__(self, interval=900, **columns):
+        unknown = set(columns) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown interval columns: {', '.join(sorted(unknown))}")
+
+        self.interval = interval
+
+        self.__columns = { k : np.asarray(columns[k], dtype=np.int64 if k == 'end_time' else np.float64)
+                           for k in COLUMNS if k in columns }
+
+        lengths = { len(v) for v in self.__columns.values() }
+        if len(lengths) > 1:
+            raise ValueError("Interval columns differ in length.")
+
+        self.__length = lengths.pop() if lengths else 0
+
+    def __len__(self):
+        return self.__length
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.__columns[key]
+
+        if isinstance(key, slice):
+            return IntervalSeries(self.interval, **{ k : v[key] for k, v in self.__columns.items() })
+
+        return { k : v[key].item() for k, v in self.__columns.items() }
+
+    def __iter__(self):
+        for i in range(self.__length):
+            yield self[i]
+
+    def __contains__(self, column):
+        return column in self.__columns
+
+    def __repr__(self):
+        return f"IntervalSeries({self.__length} x {self.interval}s: {', '.join(self.__columns)})"
+
+    def columns(self):
+        return tuple(self.__columns)
+
+    def energy(self, column):
+        return self.__columns[column] * (self.interval / 3600)
+
+    def times(self):
+        return [ time.ctime(t) for t in self.__columns['end_time'] ]
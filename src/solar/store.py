@@ -0,0 +1,198 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import sqlite3
+import pathlib
+import threading
+import logging
+import numpy as np
+
+from solar.series import IntervalSeries
+
+l = logging.getLogger('helios')
+
+class TelemetryStore():
+    __schema = { 'production_meter'  : ( 'wh_del', ),
+                 'consumption_meter' : ( 'enwh', ),
+                 'battery'           : ( 'soc', 'charge_enwh', 'discharge_enwh' ) }
+
+    __series = { 'production_meter'  : { 'produced' : 'wh_del' },
+                 'consumption_meter' : { 'consumed' : 'enwh' },
+                 'battery'           : { 'charged' : 'charge_enwh', 'soc' : 'soc' } }
+
+    def __init__(self, store_file, interval=900, read_only=False):
+        self.__store_file = store_file
+        self.__interval = interval
+        self.__lock = threading.Lock()
+
+        # Read only, a store recorded elsewhere is queried as it is and never
+        # written to.
+        if read_only:
+            self.__db = sqlite3.connect(f"{pathlib.Path(store_file).resolve().as_uri()}?mode=ro", uri=True,
+                                        check_same_thread=False)
+            self.__db.row_factory = sqlite3.Row
+            return
+
+        self.__db = sqlite3.connect(store_file, check_same_thread=False)
+        self.__db.row_factory = sqlite3.Row
+
+        with self.__lock, self.__db:
+            for meter, columns in self.__schema.items():
+                column_defs = ', '.join(f"{c} REAL" for c in columns)
+                self.__db.execute(f"CREATE TABLE IF NOT EXISTS {meter} "
+                                  f"(end_at INTEGER PRIMARY KEY, {column_defs})")
+            self.__db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.__db.execute("CREATE TABLE IF NOT EXISTS coverage (meter TEXT, start_at INTEGER, end_at INTEGER)")
+
+            for meter in self.__schema:
+                self.__seed_coverage(meter)
+
+    def __seed_coverage(self, meter):
+        # Stores written before coverage was kept are covered wherever their
+        # intervals are consecutive, anything between them is fetched again.
+        if self.__db.execute("SELECT 1 FROM coverage WHERE meter = ? LIMIT 1", (meter,)).fetchone():
+            return
+
+        end_at = np.array([ row[0] for row in self.__db.execute(f"SELECT end_at FROM {meter} ORDER BY end_at") ],
+                          dtype=np.int64)
+        if len(end_at) == 0:
+            return
+
+        breaks = np.flatnonzero(np.diff(end_at) > self.__interval)
+        firsts = np.concatenate(([0], breaks + 1))
+        lasts = np.concatenate((breaks, [len(end_at) - 1]))
+
+        self.__db.executemany("INSERT INTO coverage VALUES (?, ?, ?)",
+                              [ (meter, int(end_at[i]) - self.__interval, int(end_at[j])) for i, j in zip(firsts, lasts) ])
+
+    def __row(self, meter, interval):
+        if meter == 'production_meter':
+            return ( interval['end_at'], interval['wh_del'] )
+        elif meter == 'consumption_meter':
+            return ( interval['end_at'], interval['enwh'] )
+        else:
+            return ( interval['end_at'], interval['soc']['percent'],
+                     interval['charge']['enwh'], interval['discharge']['enwh'] )
+
+    def append(self, meter, intervals):
+        if len(intervals) == 0:
+            return
+
+        rows = [ self.__row(meter, interval) for interval in intervals ]
+        placeholders = ', '.join('?' * len(rows[0]))
+
+        with self.__lock, self.__db:
+            self.__db.executemany(f"INSERT OR REPLACE INTO {meter} VALUES ({placeholders})", rows)
+
+        l.debug(f"Stored {len(rows)} {meter} intervals in '{self.__store_file}'.")
+
+    def last_end_at(self, meter):
+        with self.__lock:
+            row = self.__db.execute(f"SELECT MAX(end_at) FROM {meter}").fetchone()
+
+        return row[0]
+
+    def cover(self, meter, start_at, end_at):
+        # Every interval ending after start_at and up to end_at has been fetched,
+        # whether or not there was data for it.
+        start_at = start_at // self.__interval * self.__interval
+        if end_at <= start_at:
+            return
+
+        with self.__lock, self.__db:
+            rows = self.__db.execute("SELECT rowid, start_at, end_at FROM coverage "
+                                     "WHERE meter = ? AND start_at <= ? AND end_at >= ?",
+                                     (meter, end_at, start_at)).fetchall()
+
+            start_at = min([ start_at ] + [ row[1] for row in rows ])
+            end_at = max([ end_at ] + [ row[2] for row in rows ])
+
+            self.__db.executemany("DELETE FROM coverage WHERE rowid = ?", [ (row[0],) for row in rows ])
+            self.__db.execute("INSERT INTO coverage VALUES (?, ?, ?)", (meter, start_at, end_at))
+
+    def missing(self, meter, since, until):
+        # The ranges between since and until that have not been fetched, as
+        # (start_at, end_at) pairs ready to be requested from start_at.
+        with self.__lock:
+            rows = self.__db.execute("SELECT start_at, end_at FROM coverage "
+                                     "WHERE meter = ? AND end_at > ? AND start_at < ? ORDER BY start_at",
+                                     (meter, since, until)).fetchall()
+
+        gaps = []
+        start_at = since
+        for covered_start, covered_end in rows:
+            if covered_start > start_at:
+                gaps.append(( start_at, covered_start ))
+            start_at = max(start_at, covered_end)
+
+        if until > start_at:
+            gaps.append(( start_at, until ))
+
+        return gaps
+
+    def __columns(self, query, params, width):
+        with self.__lock:
+            cursor = self.__db.cursor()
+            cursor.row_factory = None
+            rows = cursor.execute(query, params).fetchall()
+
+        return np.array(rows, dtype=np.float64).reshape(-1, width)
+
+    def series(self, meter, since, until=None, interval=900):
+        columns = self.__series[meter]
+
+        query = f"SELECT end_at, {', '.join(columns.values())} FROM {meter} WHERE end_at > ?"
+        params = [ since ]
+
+        if until is not None:
+            query += " AND end_at <= ?"
+            params.append(until)
+
+        data = self.__columns(f"{query} ORDER BY end_at", params, len(columns) + 1)
+
+        # Energy per interval is stored, the series holds power.
+        to_power = 3600 / interval
+        values = { name : data[:, i + 1] * (1 if name == 'soc' else to_power) for i, name in enumerate(columns) }
+
+        return IntervalSeries(interval, end_time=data[:, 0], **values)
+
+    def meter_series(self, since, until=None, interval=900):
+        query = ("SELECT p.end_at, p.wh_del, c.enwh "
+                 "FROM production_meter p JOIN consumption_meter c ON p.end_at = c.end_at "
+                 "WHERE p.end_at > ?")
+        params = [ since ]
+
+        if until is not None:
+            query += " AND p.end_at <= ?"
+            params.append(until)
+
+        data = self.__columns(f"{query} ORDER BY p.end_at", params, 3)
+
+        to_power = 3600 / interval
+        produced = data[:, 1] * to_power
+        consumed = data[:, 2] * to_power
+
+        return IntervalSeries(interval, end_time=data[:, 0], produced=produced, consumed=consumed,
+                              exported=produced - consumed)
+
+    def get_meta(self, key, default=None):
+        with self.__lock:
+            row = self.__db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self.__lock, self.__db:
+            self.__db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
@@ -0,0 +1,53 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+
+l = logging.getLogger('helios')
+
+class SurplusAllocator():
+    def __init__(self, min_amps=5, priorities=None):
+        self.__min_amps = min_amps
+        self.__priorities = priorities or {}
+
+    def __priority(self, vehicle):
+        return self.__priorities.get(vehicle['id'], self.__priorities.get(vehicle['display_name'], 0))
+
+    def __order(self, vehicles):
+        # Higher priority first, then whichever is furthest below its charge limit.
+        return sorted(vehicles, key=lambda v: (-self.__priority(v), v['charge_level'] - v['charge_limit']))
+
+    def allocate(self, amps, vehicles):
+        allocation = { v['id'] : 0 for v in vehicles }
+        remaining = amps or 0
+
+        eligible = [ v for v in self.__order(vehicles) if v['max_amps'] >= self.__min_amps ]
+
+        # Fill one vehicle at a time so as few as possible are charging, but when
+        # what would be left over is below the minimum for the next vehicle, hold
+        # some back so it can still be used.
+        for i, vehicle in enumerate(eligible):
+            if remaining < self.__min_amps:
+                break
+
+            share = min(vehicle['max_amps'], remaining)
+            leftover = remaining - share
+            if 0 < leftover < self.__min_amps and i + 1 < len(eligible):
+                if share - (self.__min_amps - leftover) >= self.__min_amps:
+                    share -= self.__min_amps - leftover
+
+            allocation[vehicle['id']] = share
+            remaining -= share
+
+        if remaining > 0:
+            l.debug(f"{remaining} amps could not be allocated.")
+
+        return allocation
@@ -0,0 +1,188 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import sqlite3
+import pathlib
+import threading
+import logging
+
+l = logging.getLogger('helios')
+
+class SessionLog():
+    __charge_columns = ( 'charging_state', 'battery_level', 'charge_limit_soc', 'charge_current_request',
+                         'charge_energy_added' )
+    __energy_columns = { 'produced' : 'REAL', 'consumed' : 'REAL', 'exported' : 'REAL', 'battery_soc' : 'INTEGER' }
+
+    def __init__(self, log_file, retention_days=365, resume_window=3600, read_only=False):
+        self.__log_file = log_file
+        self.__retention = retention_days * 86400
+        self.__resume_window = resume_window
+        self.__pruned_at = 0
+
+        self.__lock = threading.Lock()
+
+        if read_only:
+            self.__db = sqlite3.connect(f"{pathlib.Path(log_file).resolve().as_uri()}?mode=ro", uri=True,
+                                        check_same_thread=False)
+            self.__db.row_factory = sqlite3.Row
+            return
+
+        self.__db = sqlite3.connect(log_file, check_same_thread=False)
+        self.__db.row_factory = sqlite3.Row
+
+        with self.__lock, self.__db:
+            self.__db.execute("CREATE TABLE IF NOT EXISTS decisions "
+                              "(t REAL PRIMARY KEY, amp_target INTEGER, allocated INTEGER)")
+
+            # Logs written before the energy a decision was based on was kept
+            # gain its columns, empty for the decisions already in them.
+            columns = [ row['name'] for row in self.__db.execute("PRAGMA table_info(decisions)") ]
+            for column, kind in self.__energy_columns.items():
+                if column not in columns:
+                    self.__db.execute(f"ALTER TABLE decisions ADD COLUMN {column} {kind}")
+
+            self.__db.execute("CREATE TABLE IF NOT EXISTS sessions "
+                              "(id INTEGER PRIMARY KEY, vehicle_id INTEGER, started_at REAL, ended_at REAL, "
+                              "initial_amps INTEGER, start_level INTEGER, end_level INTEGER, "
+                              "last_energy REAL, energy_added REAL)")
+            self.__db.execute("CREATE TABLE IF NOT EXISTS charge_states "
+                              "(t REAL, vehicle_id INTEGER, session_id INTEGER, amps INTEGER, "
+                              "charging_state TEXT, battery_level INTEGER, charge_limit_soc INTEGER, "
+                              "charge_current_request INTEGER, charge_energy_added REAL)")
+            self.__db.execute("CREATE INDEX IF NOT EXISTS charge_states_vehicle ON charge_states (vehicle_id, t)")
+            self.__db.execute("CREATE INDEX IF NOT EXISTS sessions_vehicle ON sessions (vehicle_id, started_at)")
+
+    def __open_session(self, vehicle_id):
+        return self.__db.execute("SELECT * FROM sessions WHERE vehicle_id = ? AND ended_at IS NULL "
+                                 "ORDER BY started_at DESC LIMIT 1", (vehicle_id,)).fetchone()
+
+    def __last_t(self, session_id):
+        row = self.__db.execute("SELECT MAX(t) FROM charge_states WHERE session_id = ?", (session_id,)).fetchone()
+
+        return row[0]
+
+    def open_session(self, vehicle_id, charge_state, t=None):
+        t = t or time.time()
+
+        with self.__lock, self.__db:
+            session = self.__open_session(vehicle_id)
+
+            # A session left open by a restart is carried on, so its initial amps
+            # are the ones set before Helios first changed them.
+            if session:
+                last_t = self.__last_t(session['id']) or session['started_at']
+                if (t - last_t) <= self.__resume_window:
+                    l.debug(f"Resuming charging session {session['id']} for [{vehicle_id}].")
+                    return dict(session)
+
+                self.__db.execute("UPDATE sessions SET ended_at = ? WHERE id = ?", (last_t, session['id']))
+
+            cursor = self.__db.execute("INSERT INTO sessions (vehicle_id, started_at, initial_amps, start_level, "
+                                       "last_energy, energy_added) VALUES (?, ?, ?, ?, ?, 0)",
+                                       (vehicle_id, t, charge_state['charge_current_request'],
+                                        charge_state['battery_level'], charge_state.get('charge_energy_added')))
+
+            return dict(self.__db.execute("SELECT * FROM sessions WHERE id = ?", (cursor.lastrowid,)).fetchone())
+
+    def close_session(self, vehicle_id, charge_state=None, t=None):
+        with self.__lock, self.__db:
+            session = self.__open_session(vehicle_id)
+            if not session:
+                return None
+
+            if charge_state:
+                self.__account(session, charge_state)
+
+            self.__db.execute("UPDATE sessions SET ended_at = ? WHERE id = ?", (t or time.time(), session['id']))
+            session = self.__db.execute("SELECT * FROM sessions WHERE id = ?", (session['id'],)).fetchone()
+
+        l.info(f"Charging session for [{vehicle_id}] added {session['energy_added'] or 0:.2f} kWh.")
+
+        return dict(session)
+
+    def initial_amps(self, vehicle_id):
+        with self.__lock:
+            session = self.__open_session(vehicle_id)
+
+        return session['initial_amps'] if session else None
+
+    def record(self, amp_target, allocation, vehicles, t=None, energy=None):
+        # Vehicles are the candidates as evaluated this cycle, with the charge
+        # state that was already fetched for them, and energy the meter and
+        # battery readings the target was found from.
+        t = t or time.time()
+        energy = energy or {}
+
+        with self.__lock, self.__db:
+            self.__db.execute(f"INSERT OR REPLACE INTO decisions (t, amp_target, allocated, "
+                              f"{', '.join(self.__energy_columns)}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (t, amp_target, sum(allocation.values())) +
+                              tuple(energy.get(k) for k in self.__energy_columns))
+
+            for vehicle in vehicles:
+                cs = vehicle['charge_state']
+                session = self.__open_session(vehicle['id'])
+
+                self.__db.execute("INSERT INTO charge_states VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                  (t, vehicle['id'], session['id'] if session else None,
+                                   allocation.get(vehicle['id'], 0)) +
+                                  tuple(cs.get(k) for k in self.__charge_columns))
+
+                if session:
+                    self.__account(session, cs)
+
+            if (t - self.__pruned_at) > 86400:
+                self.__prune(t)
+
+    def __account(self, session, cs):
+        energy = cs.get('charge_energy_added')
+        if energy is None:
+            return
+
+        # The vehicle's counter restarts with each of its own charging sessions,
+        # a drop means it started again from zero.
+        last = session['last_energy']
+        added = energy - last if last is not None and energy >= last else energy
+
+        self.__db.execute("UPDATE sessions SET last_energy = ?, energy_added = energy_added + ?, end_level = ? "
+                          "WHERE id = ?", (energy, added, cs.get('battery_level'), session['id']))
+
+    def __prune(self, t):
+        cutoff = t - self.__retention
+
+        self.__db.execute("DELETE FROM decisions WHERE t < ?", (cutoff,))
+        self.__db.execute("DELETE FROM charge_states WHERE t < ?", (cutoff,))
+        self.__db.execute("DELETE FROM sessions WHERE ended_at < ?", (cutoff,))
+
+        self.__pruned_at = t
+
+    def __select(self, query, params):
+        with self.__lock:
+            rows = self.__db.execute(query, params).fetchall()
+
+        return [ dict(row) for row in rows ]
+
+    def decisions(self, since, until=None):
+        return self.__select("SELECT * FROM decisions WHERE t > ? AND t <= ? ORDER BY t",
+                             (since, until or time.time()))
+
+    def charge_states(self, vehicle_id, since, until=None):
+        return self.__select("SELECT * FROM charge_states WHERE vehicle_id = ? AND t > ? AND t <= ? ORDER BY t",
+                             (vehicle_id, since, until or time.time()))
+
+    def sessions(self, since, until=None):
+        return self.__select("SELECT * FROM sessions WHERE started_at <= ? AND (ended_at IS NULL OR ended_at > ?) "
+                             "ORDER BY started_at", (until or time.time(), since))
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
@@ -9,115 +9,98 @@
 # You should have received a copy of the GNU General Public License along with Helios.
 # If not, see <https://www.gnu.org/licenses/>.
 
-import os.path
 import time
 import requests
 import urllib
 import json
 import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+
+from net import transport, metrics, tokens, retry
+from vehicles.allocator import SurplusAllocator
+from vehicles.sessions import SessionLog
 
 l = logging.getLogger('helios')
 
+class VehicleUnavailable(requests.exceptions.RequestException):
+    pass
+
 class TeslaBaseClass():
-    def __init__(self, geoapify, token_file):
-        self._geoapify = geoapify
+    def __init__(self, geofence, token_file, deadline=60, api_url='https://owner-api.teslamotors.com/api/1',
+                 auth_url='https://auth.tesla.com/oauth2/v3/token'):
+        self._geofence = geofence
         self._token_file = token_file
+        self._vehicle_id = None
+        self._retry = retry.RetryPolicy('tesla', deadline)
 
         self._client_id = 'ownerapi'
         self._scope = 'openid email offline_access'
-        self._api_url = 'https://owner-api.teslamotors.com/api/1'
-        self._refresh_url = 'https://auth.tesla.com/oauth2/v3/token'
+        self._api_url = api_url
+        self._refresh_url = auth_url
+
+        self._tokens = tokens.manager('tesla', token_file, self.__grant)
+        self._tokens.acquire()
 
-        self.__last_refresh = None
-        self._access_headers = None
+    def __grant(self, auth_tokens):
+        if not auth_tokens:
+            raise tokens.TokenError(f"No Tesla tokens found in '{self._token_file}'.")
 
-        self.refresh_tokens()
+        refresh_data = { 'grant_type'    : 'refresh_token',
+                         'client_id'     : self._client_id,
+                         'refresh_token' : auth_tokens['refresh_token'],
+                         'scope'         : self._scope }
 
-    def _post(self, url, body, retries=10, sleep=1.1):
+        return transport.shared().post(self._refresh_url, data=refresh_data)
+
+    def __request(self, method, url, send, critical=False, max_attempts=None, deadline=None):
         api_path = urllib.parse.urlparse(url).path
-        retries += 1
 
         r = None
-        for i in range(0,retries):
+        error = None
+        attempts = self._retry.attempts(url, deadline, critical, max_attempts, self._vehicle_id)
+        for i in attempts:
+            headers = self._tokens.headers()
             try:
-                r = requests.post(url, data=json.dumps(body), headers=self._access_headers)
-            except requests.exceptions.ConnectionError as err:
-                l.error(f"Tesla API POST {api_path} => {err}")
-                time.sleep(300)
+                r = send(headers)
+            except requests.exceptions.RequestException as err:
+                l.error(f"Tesla API {method} {api_path} => {err}")
+                error = err
+                attempts.retry(type(err).__name__)
+                continue
 
             if r.status_code == 200:
+                attempts.success()
                 break
             elif r.status_code == 401:
-                time.sleep(60)
-                self.refresh_tokens(True)
-            elif r.status_code == 503:
-                time.sleep(3600)
+                self._tokens.expire(headers)
+                attempts.retry(r.status_code, 5, fault=False)
             else:
-                time.sleep(sleep)
-            sleep = sleep * 1.1 ** i
+                attempts.retry(r.status_code, fault=r.status_code >= 500)
 
-        if r.status_code == 200:
-            l.debug(f"Tesla API POST {api_path} => {r}")
-        else:
-            l.error(f"Tesla API POST {api_path} => {r}")
-
-        return r
-
-    def _get(self, url, params, retries=10, sleep=1.1):
-        api_path = urllib.parse.urlparse(url).path
-        retries += 1
-
-        r = None
-        for i in range(0, retries):
-            r = requests.get(url, params, headers=self._access_headers)
-            if r.status_code == 200:
-                break
-            elif r.status_code == 401:
-                time.sleep(60)
-                self.refresh_tokens(True)
-            elif r.status_code == 408:
-                time.sleep(300)
-            else:
-                time.sleep(sleep)
-            sleep = sleep * 1.1 ** i
+        if r is None:
+            raise error or requests.exceptions.RequestException(f"Tesla API {method} {api_path} was not sent.")
 
         if r.status_code == 200:
-            l.debug(f"Tesla API GET {api_path} => {r}")
+            l.debug(f"Tesla API {method} {api_path} => {r}")
         else:
-            l.error(f"Tesla API GET {api_path} => {r}")
+            l.error(f"Tesla API {method} {api_path} => {r}")
 
         return r
 
-    def refresh_tokens(self, force=False):
-        if self.__last_refresh and not force:
-            if (time.time() - self.__last_refresh) < 7200:
-                return
+    def _post(self, url, body, critical=False, max_attempts=None, deadline=None):
+        return self.__request('POST', url,
+                              lambda headers: transport.shared().post(url, data=json.dumps(body), headers=headers),
+                              critical, max_attempts, deadline)
 
-        auth_tokens = {}
+    def _get(self, url, params, max_attempts=None):
+        return self.__request('GET', url,
+                              lambda headers: transport.shared().get(url, params, headers=headers),
+                              max_attempts=max_attempts)
 
-        l.debug(f"Found existing tokens in '{self._token_file}', refreshing ...")
-        with open(self._token_file, 'r') as token_store:
-            auth_tokens = json.load(token_store)
-
-        refresh_data = { 'grant_type'    : 'refresh_token',
-                         'client_id'     : self._client_id,
-                         'refresh_token' : auth_tokens['refresh_token'],
-                         'scope'         : self._scope }
-
-        r = requests.post(self._refresh_url, data=refresh_data)
-        if r.status_code == 200:
-            auth_tokens = r.json()
-            with open(self._token_file, 'w') as token_store:
-                json.dump(auth_tokens, token_store)
-        else:
-            l.error(f"Failed to refresh Tesla auth tokens => {r}.  Exiting.")
-            exit(1)
-
-        self._auth_tokens = auth_tokens
-
-        self._access_headers = { 'Authorization' : f"Bearer {self._auth_tokens['access_token']}" }
-
-        self.__last_refresh = time.time()
+    def close(self):
+        tokens.release(self._tokens)
 
     def get_vehicles(self):
         url = f"{self._api_url}/vehicles"
@@ -127,125 +110,169 @@ class TeslaBaseClass():
         return r.json()['response']
 
 class TeslaInterface(TeslaBaseClass):
-    def __init__(self, vehicle_id, geoapify, token_file):
-        TeslaBaseClass.__init__(self, geoapify, token_file)
-
-        self._vehicle_id = vehicle_id
-
-        self.__init_stats_file = f".{vehicle_id}_init_stats.json"
-        self.__latest_stats_file = f".{vehicle_id}_latest_stats.json"
+    __benign_reasons = ( 'is_charging', 'not_charging', 'complete', 'already_set' )
 
-        self.__init_charging_stats = None
-        self.__latest_charging_stats = None
+    def __init__(self, vehicle_id, geofence, token_file, snapshot_ttl=60, tracker=None, deadline=60, **urls):
+        TeslaBaseClass.__init__(self, geofence, token_file, deadline, **urls)
 
-        self.__init_initial_charging_stats()
-        self.__init_latest_charging_stats()
+        self._vehicle_id = vehicle_id
 
-    def __init_initial_charging_stats(self):
-        l.debug("Retrieving and storing initial charging statistics.")
-        cs = self.get_charging_stats()
+        self.__actuator = ChargeActuator(self)
+        self.__tracker = tracker or VehicleStateTracker(self.get_vehicles)
 
-        with open(self.__init_stats_file, 'w') as init_stats:
-            json.dump(cs, init_stats)
+        self.__snapshot = None
+        self.__snapshot_time = None
+        self.__snapshot_expired = False
+        self.__snapshot_ttl = snapshot_ttl
 
-        self.__init_charging_stats = cs
+    def invalidate_snapshot(self):
+        self.__snapshot = None
+        self.__snapshot_time = None
 
-    def __init_latest_charging_stats(self):
-        if os.path.exists(self.__latest_stats_file):
-            l.debug("Retrieving last charging statistics.")
-            cs = {}
-            with open(self.__latest_stats_file, 'r') as latest_stats:
-                cs = json.load(latest_stats)
+    def expire_snapshot(self):
+        self.__snapshot_expired = True
 
-            self.__latest_charging_stats = cs
+    def reset_charge_configuration(self, amps):
+        if amps:
+            self.__actuator.set_amps(amps)
 
-    def store_latest_stats(self):
-        cs = self.get_charging_stats()
+    def apply_charging(self, amps):
+        self.__actuator.apply(amps)
 
-        with open(self.__latest_stats_file, 'w') as latest_stats:
-            json.dump(cs, latest_stats)
+    def wake(self, critical=False):
+        if self.__tracker.is_online(self._vehicle_id):
+            return
 
-        self.__latest_charging_stats = cs
+        url = f"{self._api_url}/vehicles/{self._vehicle_id}/wake_up"
 
-    def reset_charge_configuration(self):
-        self.set_charging_amps(self.__init_charging_stats['charge_current_request'])
+        l.debug(f"Waking up Tesla [{self._vehicle_id}].")
 
-    def wake(self):
-        url = f"{self._api_url}/vehicles/{self._vehicle_id}/wake_up"
+        # Waking before a stop gets one critical deadline in all, the stop is
+        # sent once it passes, awake or not.
+        give_up_at = time.time() + retry.critical_deadline() if critical else None
 
+        r_json = None
         for i in range(0,11):
-            r = self._post(url, {}, 1, 0)
+            deadline = None
+            if give_up_at:
+                deadline = give_up_at - time.time()
+                if deadline <= 0:
+                    break
+
+            r = self._post(url, {}, critical, 2, deadline)
             if r.status_code == 200:
                 r_json = r.json()['response']
+                if r_json:
+                    self.__tracker.observe(self._vehicle_id, r_json['state'])
                 if r_json and r_json['state'] == 'online':
                     break
-                time.sleep(5)
 
-        r_json = r.json()['response']
-        if r_json['state'] != 'online':
-            l.warning(f"Failed to wake up Tesla {r_json['display_name']}.")
+            if give_up_at and time.time() + 5 >= give_up_at:
+                break
+            metrics.retry_sleep('tesla', 'waking', 5)
+
+        if not r_json or r_json['state'] != 'online':
+            l.warning(f"Failed to wake up Tesla [{self._vehicle_id}].")
+            metrics.TESLA_WAKES.inc(vehicle=self._vehicle_id, result='failed')
+        else:
+            metrics.TESLA_WAKES.inc(vehicle=self._vehicle_id, result='online')
+
+    def __observe_response(self, r):
+        if r.status_code == 200:
+            self.__tracker.observe(self._vehicle_id, 'online')
+        elif r.status_code == 408:
+            self.__tracker.observe(self._vehicle_id, 'asleep')
+
+    def _command(self, command, body=None, critical=False):
+        self.wake(critical)
+        url = f"{self._api_url}/vehicles/{self._vehicle_id}/command/{command}"
+
+        # Commands are verified from their result instead of always being sent
+        # twice, a rejected command is retried once.
+        result = False
+        for i in range(0,2):
+            r = self._post(url, body or {}, critical)
+            self.__observe_response(r)
+
+            if r.status_code == 200:
+                response = r.json()['response']
+                if response['result'] or response['reason'] in self.__benign_reasons:
+                    result = True
+                    break
+                l.warning(f"Tesla command {command} rejected => {response['reason']}")
+
+        self.invalidate_snapshot()
+
+        return result
 
     def set_charging_amps(self, amps):
-        self.wake()
-        url = f"{self._api_url}/vehicles/{self._vehicle_id}/command/set_charging_amps"
         body = { 'charging_amps' : amps }
 
         l.info(f"Setting charging amps to {amps}.")
-        self._post(url, body)
-        self._post(url, body)
+        result = self._command('set_charging_amps', body)
 
-    def start_charging(self):
-        self.wake()
-        url = f"{self._api_url}/vehicles/{self._vehicle_id}/command/charge_start"
+        # Requests below 5 amps only take effect when sent a second time.
+        if result and amps < 5:
+            result = self._command('set_charging_amps', body)
 
+        return result
+
+    def start_charging(self):
         l.info("Starting to charge.")
-        self._post(url, {})
+        return self._command('charge_start')
 
     def stop_charging(self):
-        self.wake()
-        url = f"{self._api_url}/vehicles/{self._vehicle_id}/command/charge_stop"
-
         l.info("Stopped chargiging.")
-        self._post(url, {})
-        self._post(url, {})
+        return self._command('charge_stop', critical=True)
 
     def get_vehicle_data(self):
-        self.wake()
-        url = f"{self._api_url}/vehicles/{self._vehicle_id}/vehicle_data"
-
-        r = self._get(url, {})
+        if self.__snapshot and not self.__snapshot_expired:
+            if (time.time() - self.__snapshot_time) <= self.__snapshot_ttl:
+                return self.__snapshot
 
-        return r.json()['response']
+        # A vehicle that has stayed asleep since the last snapshot has neither
+        # moved nor charged, so that snapshot is still accurate and there is
+        # no need to wake it up.
+        if self.__snapshot and self.__tracker.asleep_since(self._vehicle_id, self.__snapshot_time):
+            l.debug(f"Tesla [{self._vehicle_id}] is asleep, using snapshot from {time.ctime(self.__snapshot_time)}.")
+            return self.__snapshot
 
-    def get_charge_level(self):
-        self.wake()
-        charging_stats = self.get_charging_stats()
+        url = f"{self._api_url}/vehicles/{self._vehicle_id}/vehicle_data"
 
-        return charging_stats['battery_level']
+        vdata = None
+        try:
+            self.wake()
 
-    def get_charging_stats(self):
-        self.wake()
-        url = f"{self._api_url}/vehicles/{self._vehicle_id}/vehicle_data"
+            r = self._get(url, {})
+            self.__observe_response(r)
 
-        r = self._get(url, {})
+            if r.status_code == 200:
+                vdata = r.json()['response']
+            reason = r
+        except requests.exceptions.RequestException as err:
+            reason = err
 
-        return r.json()['response']['charge_state']
+        if vdata:
+            self.__snapshot = vdata
+            self.__snapshot_time = time.time()
+            self.__snapshot_expired = False
+            return vdata
 
-    def get_init_charging_amps(self):
-        return self.__init_charging_stats['charge_current_request']
+        # Decisions go on with what was last seen rather than none at all.
+        if self.__snapshot:
+            l.warning(f"No vehicle data for Tesla [{self._vehicle_id}], using snapshot from "
+                      f"{time.ctime(self.__snapshot_time)} => {reason}")
+            return self.__snapshot
 
-    def get_last_charging_amps(self):
-        charging_amps = None
+        raise VehicleUnavailable(f"No vehicle data for Tesla [{self._vehicle_id}] => {reason}")
 
-        if os.path.exists(self.__latest_stats_file):
-            timestamp = os.path.getmtime(self.__latest_stats_file)
+    def get_charge_level(self):
+        charging_stats = self.get_charging_stats()
 
-            if self.__latest_charging_stats:
-                if (time.time() - timestamp) <= 900:
-                    charging_amps = self.__latest_charging_stats['charge_current_request']
-                    l.info(f"Found viable last charging amps of {charging_amps}.")
+        return charging_stats['battery_level']
 
-        return charging_amps
+    def get_charging_stats(self):
+        return self.get_vehicle_data()['charge_state']
 
     def get_charging_amps(self):
         charging_stats = self.get_charging_stats()
@@ -261,15 +288,12 @@ class TeslaInterface(TeslaBaseClass):
 
         return ll
 
-    def is_home(self, home_address):
+    def is_home(self):
         ll = self.get_vehicle_ll()
 
         home = False
-        if ll:
-            street_address = self._geoapify.get_street_address(ll['lat'], ll['lon'])
-
-            if street_address == home_address:
-                home = True
+        if ll and ll['lat'] is not None and ll['lon'] is not None:
+            home = self._geofence.contains(ll['lat'], ll['lon'])
 
         return home
 
@@ -302,53 +326,367 @@ class TeslaInterface(TeslaBaseClass):
 
         return charging
 
-class TeslaSelector(TeslaBaseClass):
-    def __init__(self, geoapify, token_file):
-        TeslaBaseClass.__init__(self, geoapify, token_file)
+class VehicleStateTracker():
+    def __init__(self, fetch_vehicles, online_ttl=120, listing_ttl=60, max_listing_gap=1200):
+        self.__fetch_vehicles = fetch_vehicles
+        self.__online_ttl = online_ttl
+        self.__listing_ttl = listing_ttl
+        self.__max_listing_gap = max_listing_gap
+
+        self.__lock = threading.Lock()
+        self.__states = {}
+        self.__last_online = {}
+        self.__listing_time = None
+        self.__listing = None
+        self.__blind_until = 0
+
+    def __observe(self, vehicle_id, state, now):
+        self.__states[vehicle_id] = state
+        if state == 'online':
+            self.__last_online[vehicle_id] = now
+
+    def __update_listing(self, vehicles, now):
+        # Vehicles could have woken up, driven and gone back to sleep during a
+        # long gap between listings, nothing seen before it can be trusted.
+        if not self.__listing_time or (now - self.__listing_time) > self.__max_listing_gap:
+            self.__blind_until = now
+
+        self.__listing_time = now
+        for row in vehicles:
+            self.__observe(row['id'], row['state'], now)
+
+    def update_listing(self, vehicles):
+        with self.__lock:
+            self.__update_listing(vehicles, time.time())
+
+    def observe(self, vehicle_id, state):
+        with self.__lock:
+            self.__observe(vehicle_id, state, time.time())
+
+    def get_state(self, vehicle_id):
+        # One listing is fetched at a time, outside the lock, and every caller
+        # that finds it stale waits for that one.
+        fetch = False
+        with self.__lock:
+            now = time.time()
+            listing = self.__listing
+            if not listing and (not self.__listing_time or (now - self.__listing_time) > self.__listing_ttl):
+                listing = self.__listing = Future()
+                fetch = True
+
+        if fetch:
+            listed = False
+            try:
+                vehicles = self.__fetch_vehicles()
+                with self.__lock:
+                    if vehicles:
+                        self.__update_listing(vehicles, now)
+                listed = True
+            except requests.exceptions.RequestException as err:
+                l.warning(f"Could not list Tesla vehicles => {err}")
+            finally:
+                with self.__lock:
+                    self.__listing = None
+                listing.set_result(listed)
+        elif listing:
+            listed = listing.result()
+
+        # Without a fresh listing the state is not known, callers fall back on
+        # what they have rather than fail.
+        if (fetch or listing) and not listed:
+            return 'unknown'
+
+        with self.__lock:
+            return self.__states.get(vehicle_id, 'unknown')
+
+    def is_online(self, vehicle_id):
+        with self.__lock:
+            if self.__states.get(vehicle_id) != 'online':
+                return False
+
+            return (time.time() - self.__last_online[vehicle_id]) <= self.__online_ttl
+
+    def asleep_since(self, vehicle_id, t):
+        state = self.get_state(vehicle_id)
+
+        with self.__lock:
+            if state not in ( 'asleep', 'offline' ):
+                return False
+
+            return self.__blind_until <= t and self.__last_online.get(vehicle_id, 0) <= t
+
+class ChargeActuator():
+    def __init__(self, interface, coalesce_window=60):
+        self.__interface = interface
+        self.__coalesce_window = coalesce_window
+
+        self.__last_commands = {}
+
+    def __recently_sent(self, command, value):
+        if command in self.__last_commands:
+            last_value, t = self.__last_commands[command]
+            if last_value == value and (time.time() - t) <= self.__coalesce_window:
+                l.debug(f"Skipping {command} {value}, already sent {int(time.time() - t)}s ago.")
+                return True
+
+        return False
+
+    def __sent(self, command, value, result):
+        if result:
+            self.__last_commands[command] = (value, time.time())
+        else:
+            self.__last_commands.pop(command, None)
+
+    def set_amps(self, amps):
+        charging_stats = self.__interface.get_charging_stats()
+
+        if charging_stats['charge_current_request'] == amps or self.__recently_sent('amps', amps):
+            return
+
+        self.__sent('amps', amps, self.__interface.set_charging_amps(amps))
+
+    def start(self):
+        charging_stats = self.__interface.get_charging_stats()
+
+        if charging_stats['charging_state'] == 'Charging' or self.__recently_sent('charging', True):
+            return
+
+        self.__sent('charging', True, self.__interface.start_charging())
 
+    def stop(self):
+        charging_stats = self.__interface.get_charging_stats()
+
+        if charging_stats['charging_state'] != 'Charging' or self.__recently_sent('charging', False):
+            return
+
+        self.__sent('charging', False, self.__interface.stop_charging())
+
+    def apply(self, amps):
+        if amps:
+            self.set_amps(amps)
+            self.start()
+        else:
+            self.stop()
+
+class TeslaSelector(TeslaBaseClass):
+    def __init__(self, geofence, token_file, snapshot_ttl=60, max_workers=4, vehicle_deadline=60,
+                 allocator=None, pool=None, roster=None, session_log=None, **urls):
+        TeslaBaseClass.__init__(self, geofence, token_file, vehicle_deadline, **urls)
+
+        self.__urls = urls
+        self.__snapshot_ttl = snapshot_ttl
+        self.__vehicle_deadline = vehicle_deadline
+        self.__allocator = allocator or SurplusAllocator()
+        self.__own_session_log = session_log is None
+        self.__session_log = session_log or SessionLog(':memory:')
         self.__interfaces = {}
         self.__vehicles = {}
 
-        self.__init_interfaces()
-        self.__selected = None
+        self.__own_pool = pool is None
+        self.__pool = pool or ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tesla-select')
+        self.__evaluations = {}
+        self.__results = {}
+        self.__candidates = []
+        self.__allocation = {}
+
+        self.__tracker = VehicleStateTracker(self.get_vehicles)
 
-    def __init_interfaces(self):
-        vehicles = self.get_vehicles()
+        if roster is None:
+            self.update_roster(self.get_vehicles())
+        else:
+            self.__add_vehicles(roster)
 
+    def __add_vehicles(self, vehicles):
         for row in vehicles:
             vehicle_id = row['id']
 
             self.__vehicles[vehicle_id] = row
 
+            if vehicle_id in self.__interfaces:
+                continue
+
             l.info(f"Found vehicle named {row['display_name']} [{row['id']}].")
 
-            self.__interfaces[vehicle_id] = TeslaInterface(vehicle_id, self._geoapify, self._token_file)
+            self.__interfaces[vehicle_id] = TeslaInterface(vehicle_id, self._geofence, self._token_file,
+                                                           self.__snapshot_ttl, self.__tracker,
+                                                           self.__vehicle_deadline, **self.__urls)
 
-    def select_vehicle(self, home_address):
-        candidate_vehicles = []
+    def update_roster(self, vehicles):
+        self.__tracker.update_listing(vehicles)
 
-        for id in self.__vehicles:
-            if not self.__interfaces[id].is_home(home_address):
+        listed = [ row['id'] for row in vehicles ]
+        for vehicle_id in list(self.__vehicles):
+            if vehicle_id in listed or vehicle_id in self.__evaluations:
                 continue
 
-            if not self.__interfaces[id].is_connected():
-                continue
+            l.info(f"Vehicle {self.__vehicles[vehicle_id]['display_name']} [{vehicle_id}] is no longer listed.")
+
+            if self.__allocation.pop(vehicle_id, None):
+                self.__session_log.close_session(vehicle_id)
+            del self.__vehicles[vehicle_id]
+            self.__interfaces.pop(vehicle_id).close()
+
+        self.__add_vehicles(vehicles)
 
-            self.__vehicles[id]['charge_level'] = self.__interfaces[id].get_charge_level()
-            candidate_vehicles.append(self.__vehicles[id])
+    def set_allocator(self, allocator):
+        self.__allocator = allocator
 
-        candidates_sorted = sorted(candidate_vehicles, key=lambda d: d['charge_level'])
-        count = len(candidates_sorted)
+    def get_roster(self):
+        # Only what identifies a vehicle, its state is stale as soon as it is saved.
+        return [ { k : row[k] for k in ( 'id', 'vehicle_id', 'vin', 'display_name' ) if k in row }
+                 for row in self.__vehicles.values() ]
 
-        if count > 0:
-            last_selected = self.__selected
-            self.__selected = self.__interfaces[candidates_sorted[0]['id']]
+    def expire_snapshots(self):
+        for id in self.__interfaces:
+            self.__interfaces[id].expire_snapshot()
 
-            if self.__selected != last_selected:
-                l.info(f"Selected {candidates_sorted[0]['display_name']} [{candidates_sorted[0]['id']}] @ {candidates_sorted[0]['charge_level']}% charge level.")
-                if last_selected:
-                    if last_selected.is_charging():
-                        last_selected.stop_charging()
-                    last_selected.reset_charge_configuration()
+    def __evaluate_vehicle(self, id):
+        interface = self.__interfaces[id]
 
-        return self.__selected
+        if not interface.is_home():
+            return { 'state' : 'away' }
+
+        if not interface.is_connected():
+            return { 'state' : 'disconnected' }
+
+        if interface.is_charged():
+            return { 'state' : 'charged' }
+
+        charging_stats = interface.get_charging_stats()
+
+        return { 'state'        : 'candidate',
+                 'charge_level' : charging_stats['battery_level'],
+                 'charge_limit' : charging_stats['charge_limit_soc'],
+                 'max_amps'     : charging_stats['charge_current_request_max'],
+                 'charge_state' : charging_stats }
+
+    def __evaluate_vehicles(self):
+        # Evaluations still running from an earlier selection are left alone, the
+        # vehicle is reported as unknown until they finish.
+        for id in self.__vehicles:
+            if id not in self.__evaluations:
+                self.__evaluations[id] = self.__pool.submit(self.__evaluate_vehicle, id)
+
+        self.__wait_evaluations()
+
+        results = {}
+        for id in list(self.__evaluations):
+            future = self.__evaluations[id]
+
+            if not future.done():
+                l.warning(f"State of {self.__vehicles[id]['display_name']} [{id}] is unknown, still waiting on vehicle.")
+                results[id] = { 'state' : 'unknown' }
+                continue
+
+            del self.__evaluations[id]
+
+            try:
+                results[id] = future.result()
+            except Exception as err:
+                l.error(f"Failed to evaluate {self.__vehicles[id]['display_name']} [{id}] => {err}")
+                results[id] = { 'state' : 'unknown' }
+
+        return results
+
+    def __wait_evaluations(self):
+        # A selection takes at most one vehicle deadline however many vehicles
+        # there are, evaluations still queued or running are reported as unknown
+        # and picked up by a later selection.
+        pending = [ future for future in self.__evaluations.values() if not future.done() ]
+        if pending:
+            wait(pending, timeout=self.__vehicle_deadline)
+
+    def evaluate(self):
+        self.__results = self.__evaluate_vehicles()
+
+        self.__candidates = []
+        for id, result in self.__results.items():
+            if result['state'] == 'candidate':
+                self.__candidates.append(dict(self.__vehicles[id], **result))
+            elif result['state'] != 'unknown' and id in self.__allocation:
+                l.info(f"{self.__vehicles[id]['display_name']} [{id}] is {result['state']}.")
+
+        return list(self.__candidates)
+
+    def __release(self, id):
+        interface = self.__interfaces[id]
+
+        # Fetched for is_charging anyway, and closes out the session's energy.
+        # Stopping does not depend on it, when in doubt the stop is sent.
+        charge_state = None
+        try:
+            charge_state = interface.get_charging_stats()
+        except Exception as err:
+            l.warning(f"Could not get the charge state of [{id}] => {err}")
+
+        if not charge_state or charge_state['charging_state'] == 'Charging':
+            interface.stop_charging()
+        interface.reset_charge_configuration(self.__session_log.initial_amps(id))
+
+        self.__session_log.close_session(id, charge_state)
+        del self.__allocation[id]
+
+    def allocate(self, amps, energy=None):
+        # Leave a vehicle that could not be reached as it is, its share of the
+        # surplus is still in use.
+        held = sum(self.__allocation[id] for id, result in self.__results.items()
+                   if result['state'] == 'unknown' and id in self.__allocation)
+
+        allocation = self.__allocator.allocate(max((amps or 0) - held, 0), self.__candidates)
+
+        for vehicle in self.__candidates:
+            id = vehicle['id']
+            if allocation[id] and allocation[id] != self.__allocation.get(id):
+                l.info(f"Allocated {allocation[id]} amps to {vehicle['display_name']} [{id}] @ {vehicle['charge_level']}% charge level.")
+
+        # A vehicle that cannot be commanded keeps what it had and is tried
+        # again next cycle, the others are still adjusted.
+        for id in list(self.__allocation):
+            if self.__results.get(id, {}).get('state') != 'unknown' and not allocation.get(id):
+                try:
+                    self.__release(id)
+                except requests.exceptions.RequestException as err:
+                    l.error(f"Failed to release {self.__vehicles[id]['display_name']} [{id}] => {err}")
+
+        for vehicle in self.__candidates:
+            id = vehicle['id']
+            if allocation[id]:
+                try:
+                    self.__interfaces[id].apply_charging(allocation[id])
+                except requests.exceptions.RequestException as err:
+                    l.error(f"Failed to charge {vehicle['display_name']} [{id}] at {allocation[id]} amps => {err}")
+                    continue
+
+                if id not in self.__allocation:
+                    self.__session_log.open_session(id, vehicle['charge_state'])
+                self.__allocation[id] = allocation[id]
+
+        self.__session_log.record(amps, self.__allocation, self.__candidates, energy=energy)
+
+        return dict(self.__allocation)
+
+    def close(self):
+        # Only what was created here, a shared pool or session log belongs to
+        # the site.
+        for interface in self.__interfaces.values():
+            interface.close()
+        TeslaBaseClass.close(self)
+
+        if self.__own_pool:
+            self.__pool.shutdown(wait=False, cancel_futures=True)
+        if self.__own_session_log:
+            self.__session_log.close()
+
+    def release_all(self):
+        # An evaluation still running would race the release of its vehicle,
+        # queued ones are dropped and running ones given a deadline to finish.
+        for future in self.__evaluations.values():
+            future.cancel()
+        wait(list(self.__evaluations.values()), timeout=self.__vehicle_deadline)
+        self.__evaluations = {}
+
+        for id in list(self.__allocation):
+            try:
+                self.__release(id)
+            except Exception as err:
+                l.error(f"Failed to release {self.__vehicles[id]['display_name']} [{id}] => {err}")
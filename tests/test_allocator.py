@@ -0,0 +1,61 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+from vehicles.allocator import SurplusAllocator
+
+def vehicle(id, charge_level=50, charge_limit=80, max_amps=32, display_name=None):
+    return { 'id'           : id,
+             'display_name' : display_name or f"Car {id}",
+             'charge_level' : charge_level,
+             'charge_limit' : charge_limit,
+             'max_amps'     : max_amps }
+
+def test_single_vehicle_capped_at_max_amps():
+    allocator = SurplusAllocator()
+
+    assert allocator.allocate(20, [ vehicle(1) ]) == { 1 : 20 }
+    assert allocator.allocate(40, [ vehicle(1) ]) == { 1 : 32 }
+
+def test_below_minimum_allocates_nothing():
+    allocator = SurplusAllocator(min_amps=5)
+
+    assert allocator.allocate(4, [ vehicle(1), vehicle(2) ]) == { 1 : 0, 2 : 0 }
+    assert allocator.allocate(None, [ vehicle(1) ]) == { 1 : 0 }
+
+def test_fills_furthest_below_limit_first():
+    allocator = SurplusAllocator()
+
+    allocation = allocator.allocate(40, [ vehicle(1, charge_level=70), vehicle(2, charge_level=30) ])
+
+    assert allocation == { 1 : 8, 2 : 32 }
+
+def test_holds_back_minimum_for_next_vehicle():
+    allocator = SurplusAllocator(min_amps=5)
+
+    # A full 32 amps would leave 3 over after the first vehicle, 2 are held
+    # back so the second can charge at the minimum.
+    allocation = allocator.allocate(35, [ vehicle(1, charge_level=30), vehicle(2, charge_level=70) ])
+
+    assert allocation == { 1 : 30, 2 : 5 }
+
+def test_priority_before_charge_level():
+    allocator = SurplusAllocator(priorities={ 'Car 2' : 1 })
+
+    allocation = allocator.allocate(20, [ vehicle(1, charge_level=10), vehicle(2, charge_level=70) ])
+
+    assert allocation == { 1 : 0, 2 : 20 }
+
+def test_vehicle_unable_to_reach_minimum_is_skipped():
+    allocator = SurplusAllocator(min_amps=5)
+
+    allocation = allocator.allocate(20, [ vehicle(1, charge_level=10, max_amps=4), vehicle(2) ])
+
+    assert allocation == { 1 : 0, 2 : 20 }
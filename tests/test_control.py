@@ -0,0 +1,75 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+from control import PIControl
+
+VOLTAGE = 240
+
+def run(pi, available, steps, applied=0, max_draw=80):
+    # The surplus is what is left of the available power once the vehicles
+    # draw what was applied, at most max_draw amps.
+    targets = []
+    for i in range(steps):
+        target = pi.update(available - applied * VOLTAGE, applied)
+        applied = min(target or 0, max_draw)
+        pi.set_applied(applied)
+        targets.append(target)
+
+    return targets, applied
+
+def test_converges_on_the_surplus():
+    pi = PIControl(voltage=VOLTAGE, min_command_interval=0)
+
+    targets, applied = run(pi, 20 * VOLTAGE, 20)
+
+    assert 19 <= targets[-1] <= 20
+    assert len(set(targets[-5:])) == 1
+
+def test_small_changes_are_held():
+    pi = PIControl(voltage=VOLTAGE, min_command_interval=0)
+
+    targets, applied = run(pi, 20 * VOLTAGE, 20)
+    held = targets[-1]
+
+    # Within the deadband nothing moves.
+    targets, applied = run(pi, 20 * VOLTAGE + 100, 5, applied)
+
+    assert targets == [ held ] * 5
+
+def test_increases_wait_for_command_interval():
+    pi = PIControl(voltage=VOLTAGE, min_command_interval=3600)
+
+    first = pi.update(10 * VOLTAGE, 0)
+    second = pi.update(10 * VOLTAGE, first)
+
+    assert first == 10
+    assert second == first
+
+def test_anti_windup():
+    pi = PIControl(voltage=VOLTAGE, min_command_interval=0)
+
+    # The vehicle only takes 10 amps of a large surplus, then the sun goes.
+    targets, applied = run(pi, 60 * VOLTAGE, 30, max_draw=10)
+    targets, applied = run(pi, 0, 2, applied, max_draw=10)
+
+    assert targets[-1] is None
+
+def test_windup_without_feedback():
+    pi = PIControl(voltage=VOLTAGE, min_command_interval=0)
+
+    # Without being told what was applied the integral runs to its limit,
+    # which is what set_applied guards against above.
+    applied = 0
+    for i in range(30):
+        target = pi.update(60 * VOLTAGE - applied * VOLTAGE, applied)
+        applied = min(target or 0, 10)
+
+    assert pi.update(-applied * VOLTAGE, applied) is not None
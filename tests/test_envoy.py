@@ -0,0 +1,55 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from net import transport
+from solar.envoy import EnvoyInterface
+from solar.series import TelemetryUnavailable
+
+class Envoy():
+    def __init__(self, soc):
+        self.soc = soc
+
+    def get(self, url, headers=None, verify=None, **kwargs):
+        meters = { 'pv'      : { 'agg_p_mw' : 5000000 },
+                   'load'    : { 'agg_p_mw' : 1000000 },
+                   'storage' : { 'agg_p_mw' : -500000 } }
+        if self.soc is not None:
+            meters['soc'] = self.soc
+
+        return Response({ 'connection' : { 'sc_stream' : 'enabled' }, 'meters' : meters })
+
+class Response():
+    def __init__(self, data):
+        self.status_code = 200
+        self.__data = data
+
+    def json(self):
+        return self.__data
+
+def test_battery_charge(monkeypatch):
+    monkeypatch.setattr(transport, '_shared', Envoy(63))
+    envoy = EnvoyInterface('https://envoy.local', sample_interval=0)
+
+    battery = envoy.get_battery_charge()
+
+    assert battery['level'] == 63
+    assert battery['intervals']['charged'][-1] == 500
+
+def test_no_battery_charge_skips(monkeypatch):
+    monkeypatch.setattr(transport, '_shared', Envoy(None))
+    envoy = EnvoyInterface('https://envoy.local', sample_interval=0)
+
+    with pytest.raises(TelemetryUnavailable):
+        envoy.get_battery_charge()
+
+    assert envoy.get_meters()['exported'][-1] == 4000
@@ -0,0 +1,77 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import time
+
+from control import IntervalScheduler
+from solar.quota import QuotaBudget, PRIORITY_CONTROL, PRIORITY_BACKGROUND
+from solar.store import TelemetryStore
+
+def test_per_minute_limit():
+    quota = QuotaBudget(per_minute=3, max_wait=0)
+
+    assert all(quota.acquire() for i in range(3))
+    assert not quota.acquire()
+
+def test_throttle_defers_background():
+    quota = QuotaBudget(per_minute=10, max_wait=0)
+
+    quota.throttle()
+
+    assert not quota.acquire(PRIORITY_BACKGROUND)
+
+def test_reserve_kept_for_control():
+    quota = QuotaBudget(per_minute=100, per_month=10, reserve=0.2)
+
+    background = [ quota.acquire(PRIORITY_BACKGROUND) for i in range(10) ]
+    control = [ quota.acquire(PRIORITY_CONTROL) for i in range(3) ]
+
+    assert background.count(True) == 8
+    assert control == [ True, True, False ]
+    assert quota.remaining()['month'] == 0
+
+def test_month_used_persisted(tmp_path):
+    store = TelemetryStore(str(tmp_path / 'telemetry.db'))
+
+    quota = QuotaBudget(per_minute=100, per_month=1000, store=store)
+    for i in range(5):
+        quota.acquire()
+
+    assert QuotaBudget(per_month=1000, store=store).remaining()['month'] == 995
+
+    store.close()
+
+class Telemetry():
+    def __init__(self, quota):
+        self.quota = quota
+
+    def get_quota(self):
+        return self.quota
+
+    def get_latest_interval_end(self, probe=False):
+        return int(time.time() // 900 * 900)
+
+def stride(quota, active_hours=12):
+    scheduler = IntervalScheduler(Telemetry(quota), active_hours=active_hours)
+    scheduler.poll()
+
+    return scheduler.get_stride()
+
+def test_stride_follows_quota():
+    assert stride(None) == 1
+    assert stride({ 'minute' : 10, 'month' : 900, 'per_hour' : 100 }) == 1
+    assert stride({ 'minute' : 10, 'month' : 200, 'per_hour' : 1 }) == 6
+    assert stride({ 'minute' : 10, 'month' : 0, 'per_hour' : 0 }) == 8
+
+def test_stride_spread_over_active_hours():
+    quota = { 'minute' : 10, 'month' : 200, 'per_hour' : 1 }
+
+    assert stride(quota, active_hours=6) < stride(quota, active_hours=12)
@@ -0,0 +1,100 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from net import retry
+from net.retry import CircuitBreaker, CircuitOpen
+
+class Clock():
+    def __init__(self, monkeypatch):
+        self.now = 1000000
+        monkeypatch.setattr(retry.time, 'time', lambda: self.now)
+
+def test_opens_after_threshold(monkeypatch):
+    Clock(monkeypatch)
+    breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=60)
+
+    for i in range(2):
+        breaker.failure()
+    breaker.check()
+
+    breaker.failure()
+    with pytest.raises(CircuitOpen):
+        breaker.check()
+
+def test_success_resets_failures(monkeypatch):
+    Clock(monkeypatch)
+    breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=60)
+
+    breaker.failure()
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    breaker.failure()
+
+    breaker.check()
+
+def test_single_trial_after_timeout(monkeypatch):
+    clock = Clock(monkeypatch)
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=60)
+
+    breaker.failure()
+    clock.now += 60
+
+    breaker.check()
+    with pytest.raises(CircuitOpen):
+        breaker.check()
+
+def test_failed_trial_reopens(monkeypatch):
+    clock = Clock(monkeypatch)
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=60)
+
+    breaker.failure()
+    clock.now += 60
+    breaker.check()
+    breaker.failure()
+
+    clock.now += 30
+    with pytest.raises(CircuitOpen):
+        breaker.check()
+
+def test_successful_trial_closes(monkeypatch):
+    clock = Clock(monkeypatch)
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=60)
+
+    breaker.failure()
+    clock.now += 60
+    breaker.check()
+    breaker.success()
+
+    breaker.check()
+    breaker.check()
+
+def test_breakers_keyed_per_vehicle():
+    url = 'https://owner-api.teslamotors.com/api/1/vehicles/{}/command/charge_start'
+
+    assert retry.breaker('tesla', url.format(1)) is retry.breaker('tesla', url.format(2))
+    assert retry.breaker('tesla', url.format(1), 1) is not retry.breaker('tesla', url.format(2), 2)
+    assert retry.breaker('tesla', url.format(1), 1) is retry.breaker('tesla', url.format(1), 1)
+
+def test_critical_attempts_ignore_open_circuit():
+    policy = retry.RetryPolicy('test-critical')
+    url = 'https://example.com/critical'
+
+    breaker = retry.breaker('test-critical', url)
+    for i in range(retry._settings['failure_threshold']):
+        breaker.failure()
+
+    with pytest.raises(CircuitOpen):
+        list(policy.attempts(url))
+
+    assert list(policy.attempts(url, critical=True, max_attempts=1)) == [ 0 ]
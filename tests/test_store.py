@@ -0,0 +1,187 @@
+# This file is part of Helios.
+#
+# Helios is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License version 3 as published by the Free Software Foundation.
+# Helios is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Helios.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import time
+import sqlite3
+import urllib
+import pytest
+import requests
+
+from net import transport, retry
+from solar.enphase import EnphaseInterface
+from solar.store import TelemetryStore
+from solar.series import TelemetryUnavailable
+
+INTERVAL = 900
+DAY = 86400
+
+def intervals(meter, end_ats):
+    if meter == 'production_meter':
+        return [ { 'end_at' : t, 'wh_del' : 100 } for t in end_ats ]
+    elif meter == 'consumption_meter':
+        return [ { 'end_at' : t, 'enwh' : 50 } for t in end_ats ]
+
+    return [ { 'end_at' : t, 'soc' : { 'percent' : 60 }, 'charge' : { 'enwh' : 0 }, 'discharge' : { 'enwh' : 0 } }
+             for t in end_ats ]
+
+def test_missing_on_empty_store(tmp_path):
+    store = TelemetryStore(str(tmp_path / 'telemetry.db'))
+
+    assert store.missing('production_meter', 0, 9000) == [ ( 0, 9000 ) ]
+
+def test_cover_merges_ranges(tmp_path):
+    store = TelemetryStore(str(tmp_path / 'telemetry.db'))
+
+    store.cover('production_meter', 0, 3600)
+    store.cover('production_meter', 7200, 9000)
+    assert store.missing('production_meter', 0, 9000) == [ ( 3600, 7200 ) ]
+
+    store.cover('production_meter', 3600, 7200)
+    assert store.missing('production_meter', 0, 9000) == []
+
+    # Only other meters are left to fetch.
+    assert store.missing('consumption_meter', 0, 9000) == [ ( 0, 9000 ) ]
+
+def test_coverage_seeded_from_existing_intervals(tmp_path):
+    path = str(tmp_path / 'telemetry.db')
+
+    store = TelemetryStore(path)
+    store.append('production_meter', intervals('production_meter', [ 900, 1800, 2700, 5400, 6300 ]))
+    store.close()
+
+    # A store written before coverage was kept.
+    db = sqlite3.connect(path)
+    with db:
+        db.execute("DELETE FROM coverage")
+    db.close()
+
+    store = TelemetryStore(path)
+    assert store.missing('production_meter', 0, 6300) == [ ( 2700, 4500 ) ]
+
+class Enphase():
+    # Publishes an interval every 15 minutes for the last ten days, a week at
+    # a time from the requested start.
+    def __init__(self, now):
+        self.now = now
+        self.calls = []
+        self.down = False
+
+    def get(self, url, headers=None, **kwargs):
+        parsed = urllib.parse.urlparse(url)
+        meter = parsed.path.split('/')[-1]
+        start_at = int(urllib.parse.parse_qs(parsed.query)['start_at'][0])
+
+        self.calls.append(( meter, start_at ))
+
+        if self.down:
+            raise requests.exceptions.ConnectionError("Connection refused")
+
+        first = max(start_at, self.now - 10 * DAY) // INTERVAL * INTERVAL + INTERVAL
+        last = min(start_at + 7 * DAY, self.now)
+        data = { 'intervals' : intervals(meter, list(range(first, last + 1, INTERVAL))) }
+        if meter == 'battery':
+            data['last_reported_aggregate_soc'] = '60%'
+
+        return Response(data)
+
+class Response():
+    def __init__(self, data):
+        self.status_code = 200
+        self.__data = data
+
+    def json(self):
+        return self.__data
+
+def build(tmp_path, monkeypatch):
+    now = int(time.time()) // INTERVAL * INTERVAL
+    enphase = Enphase(now)
+    monkeypatch.setattr(transport, '_shared', enphase)
+
+    token_file = tmp_path / 'tokens.json'
+    token_file.write_text(json.dumps({ 'access_token' : 'a', 'refresh_token' : 'r', 'expires_in' : 7200 }))
+
+    interface = EnphaseInterface('1', 'key', 'client', 'secret', 'code', str(token_file),
+                                 str(tmp_path / 'telemetry.db'), str(tmp_path / 'generation.json'),
+                                 quota={ 'per_minute' : 1000 })
+    interface.authorize()
+
+    return interface, enphase
+
+def test_sync_fetches_only_what_is_missing(tmp_path, monkeypatch):
+    interface, enphase = build(tmp_path, monkeypatch)
+
+    assert len(interface.get_meters()) == 4
+    assert len(enphase.calls) == 2
+
+    # Already covered, nothing is fetched again.
+    enphase.calls.clear()
+    interface.get_meters()
+    assert enphase.calls == []
+
+    interface.close()
+
+def test_backfill_history(tmp_path, monkeypatch):
+    interface, enphase = build(tmp_path, monkeypatch)
+
+    interface.get_meters()
+    interface.get_forecast()
+
+    store = TelemetryStore(str(tmp_path / 'telemetry.db'))
+    now = enphase.now
+
+    assert len(store.series('consumption_meter', now - 8 * DAY)) == 8 * DAY // INTERVAL
+    assert store.missing('consumption_meter', now - 8 * DAY, now) == []
+
+    store.close()
+    interface.close()
+
+def test_gap_refilled(tmp_path, monkeypatch):
+    interface, enphase = build(tmp_path, monkeypatch)
+    interface.get_forecast()
+
+    # Intervals lost from the middle of the history, with their coverage, as
+    # after downtime.
+    now = enphase.now
+    db = sqlite3.connect(str(tmp_path / 'telemetry.db'))
+    with db:
+        db.execute("DELETE FROM consumption_meter WHERE end_at > ? AND end_at <= ?", (now - 3 * DAY, now - 2 * DAY))
+        db.execute("DELETE FROM coverage WHERE meter = 'consumption_meter'")
+        db.execute("INSERT INTO coverage VALUES ('consumption_meter', ?, ?)", (now - 10 * DAY, now - 3 * DAY))
+        db.execute("INSERT INTO coverage VALUES ('consumption_meter', ?, ?)", (now - 2 * DAY, now))
+    db.close()
+
+    enphase.calls.clear()
+    interface.get_forecast()
+
+    assert enphase.calls == [ ( 'consumption_meter', now - 3 * DAY ) ]
+
+    store = TelemetryStore(str(tmp_path / 'telemetry.db'))
+    assert len(store.series('consumption_meter', now - 3 * DAY, now - 2 * DAY)) == DAY // INTERVAL
+
+    store.close()
+    interface.close()
+
+def test_outage_skips_cycle(tmp_path, monkeypatch):
+    monkeypatch.setattr(retry, '_breakers', {})
+    monkeypatch.setitem(retry._settings, 'base_delay', 0)
+    monkeypatch.setitem(retry._settings, 'max_delay', 0)
+
+    interface, enphase = build(tmp_path, monkeypatch)
+    enphase.down = True
+
+    # Retries running out, then the circuit failing fast, both leave the cycle
+    # to be skipped rather than the error reaching the site.
+    for i in range(3):
+        with pytest.raises(TelemetryUnavailable):
+            interface.get_meters()
+
+    interface.close()